@@ -7,6 +7,7 @@ Email: i(at)huxuan.org
 Description: init file for app.
 """
 from functools import partial
+import logging
 
 from flask import Flask
 from flask import jsonify
@@ -16,12 +17,18 @@ from flask.ext.sqlalchemy import SQLAlchemy
 app = Flask(__name__)
 app.config.from_object('config')
 
+# NOTE: One handler on the root logger, unless uWSGI or the caller has set
+# one up already, and INFO for the loggers of the modules of app.
+logging.basicConfig()
+logging.getLogger(__name__).setLevel(logging.INFO)
+
 cors = CORS(app)
 db = SQLAlchemy(app)
 
 from app import models
 from app import utils
 from app import admin
+from app import query_stats
 
 from app.account import account
 from app.apartment import apartment
@@ -45,7 +45,7 @@ admin.add_view(views.MyModelView(models.Photo, db.session,
     endpoint='admin_photo', category="Model"))
 admin.add_view(views.MyModelView(models.Tag, db.session,
     endpoint='admin_tag', category="Model"))
-admin.add_view(views.MyModelView(models.Rent, db.session,
+admin.add_view(views.RentModelView(models.Rent, db.session,
     endpoint='admin_rent', category="Model"))
 admin.add_view(views.MyModelView(models.Reserve, db.session,
     endpoint='admin_reserve', category="Model"))
@@ -21,6 +21,8 @@ from flask.ext.login import logout_user
 from jinja2 import Markup
 
 from . import forms
+from app import db
+from app import models
 
 
 class MyAdminIndexView(AdminIndexView):
@@ -63,6 +65,17 @@ class MyModelView(ModelView, MyView):
     column_auto_select_related = True
 
 
+class RentModelView(MyModelView):
+
+    def after_model_change(self, form, model, is_created):
+        models.Room.update_availability([model.room_id])
+        db.session.commit()
+
+    def after_model_delete(self, model):
+        models.Room.update_availability([model.room_id])
+        db.session.commit()
+
+
 class ConfirmModelView(MyModelView):
     can_create = False
     can_delete = False
@@ -9,12 +9,17 @@ Description: Init file for api blueprint.
 from flask import Blueprint
 from flask import Flask
 from flask import jsonify
+from flask import request
 
+from .. import app
 from .. import models
 from .. import utils
 
 bp_api = Blueprint('api', __name__)
 
+# SMS received by the stub gateway, newest last.
+sms_requests = []
+
 
 @bp_api.route('/')
 @bp_api.route('/test')
@@ -26,3 +31,13 @@ def response():
 @bp_api.route('/test/exception')
 def test():
     raise utils.APIException(message='APIException from {}!'.format(__name__))
+
+
+@bp_api.route('/test/sms', methods=['POST'])
+def sms():
+    """ Stub of the EMY gateway, only available in debug mode. """
+    if not app.debug:
+        raise utils.APIException(utils.API_CODE_NOT_FOUND, name='sms')
+    sms_requests.append(request.form.to_dict())
+    return '<?xml version="1.0" encoding="UTF-8"?>' \
+        '<response><error>0</error><message></message></response>'
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: cache.py
+Author: huxuan
+Email: i(at)huxuan.org
+Description: Caches for hot reads.
+
+The backend is chosen by `CACHE_BACKEND`, so that caches stay coherent when
+several uWSGI workers, or several hosts, serve the API.
+"""
+from collections import OrderedDict
+from threading import Lock
+from time import time
+import cPickle as pickle
+import logging
+
+from app import app
+
+logger = logging.getLogger(__name__)
+
+
+class Cache(object):
+    """ Interface of cache backends. Keys are strings or tuples, values are
+    anything picklable. """
+
+    def __init__(self, namespace, ttl=60):
+        self.namespace = namespace
+        self.ttl = ttl
+
+    def make_key(self, key):
+        if not isinstance(key, basestring):
+            key = repr(key)
+        return '{}{}:{}'.format(app.config['CACHE_KEY_PREFIX'],
+            self.namespace, key)
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LRUCache(Cache):
+    """ A thread safe in-process cache which evicts the least recently used
+    entry beyond `max_size` and expires entries older than `ttl` seconds.
+    """
+
+    def __init__(self, namespace='', ttl=60, max_size=1024):
+        super(LRUCache, self).__init__(namespace, ttl)
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.pop(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time():
+                return None
+            self.data[key] = item
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (expires, value)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class UWSGICache(Cache):
+    """ The shared memory cache of uWSGI, seen by all workers on one host.
+
+    Needs a `cache2` option naming `CACHE_UWSGI_NAME` in fangmi-api.ini, so
+    it only works when running under uWSGI. `clear` drops the whole uWSGI
+    cache, not only this namespace. Values larger than the `blocksize` of
+    the cache2 option (64 KB) do not fit and are never cached, which is
+    logged as a warning.
+    """
+
+    def __init__(self, namespace, ttl=60):
+        super(UWSGICache, self).__init__(namespace, ttl)
+        import uwsgi
+        self.uwsgi = uwsgi
+        self.name = app.config['CACHE_UWSGI_NAME']
+
+    def get(self, key):
+        value = self.uwsgi.cache_get(self.make_key(key), self.name)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if not self.uwsgi.cache_update(self.make_key(key), value,
+                self.ttl if ttl is None else ttl, self.name):
+            logger.warning('uwsgi cache rejected {} ({} bytes)'.format(
+                self.make_key(key), len(value)))
+
+    def delete(self, key):
+        self.uwsgi.cache_del(self.make_key(key), self.name)
+
+    def clear(self):
+        self.uwsgi.cache_clear(self.name)
+
+
+class RedisCache(Cache):
+    """ A cache on a server speaking the Redis protocol, shared by all hosts.
+
+    Run cache_server.py for a local stand-in in development. `clear` only
+    deletes the keys of this namespace. When the server is unreachable the
+    error is logged, reads miss and writes are dropped, so the API keeps
+    working off the database.
+    """
+
+    def __init__(self, namespace, ttl=60):
+        super(RedisCache, self).__init__(namespace, ttl)
+        import redis
+        self.redis = redis
+        self.client = redis.StrictRedis.from_url(
+            app.config['CACHE_REDIS_URL'],
+            socket_timeout=app.config['CACHE_REDIS_TIMEOUT_SECONDS'])
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.make_key(key))
+        except self.redis.RedisError:
+            logger.exception('redis cache get failed')
+            return None
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.client.set(self.make_key(key),
+                pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                ex=self.ttl if ttl is None else ttl)
+        except self.redis.RedisError:
+            logger.exception('redis cache set failed')
+
+    def delete(self, key):
+        try:
+            self.client.delete(self.make_key(key))
+        except self.redis.RedisError:
+            logger.exception('redis cache delete failed')
+
+    def clear(self):
+        try:
+            keys = self.client.keys(self.make_key('*'))
+            if keys:
+                self.client.delete(*keys)
+        except self.redis.RedisError:
+            logger.exception('redis cache clear failed')
+
+
+BACKENDS = dict(
+    local=LRUCache,
+    uwsgi=UWSGICache,
+    redis=RedisCache,
+)
+
+
+def create(namespace, ttl=60, max_size=1024):
+    """ A cache of the configured backend, max_size only bounds the local
+    backend. """
+    backend = BACKENDS[app.config['CACHE_BACKEND']]
+    if backend is LRUCache:
+        return LRUCache(namespace, ttl=ttl, max_size=max_size)
+    return backend(namespace, ttl=ttl)
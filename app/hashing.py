@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: hashing.py
+Author: huxuan
+Email: i(at)huxuan.org
+Description: Password hashing policy.
+
+Hashes are stored in the werkzeug format `method$salt$hash`, where the method
+prefix, e.g. `pbkdf2:sha256:10000`, names the algorithm and the cost the hash
+was made with. A hash whose prefix differs from the one werkzeug writes for
+`PASSWORD_HASH_METHOD` is replaced on the next successful login, so the
+policy can be changed without a migration.
+"""
+from werkzeug.security import check_password_hash
+from werkzeug.security import generate_password_hash
+
+from app import app
+
+policy_prefixes = {}
+
+
+def get_method(method=None):
+    return method or app.config['PASSWORD_HASH_METHOD']
+
+
+def generate(password, method=None):
+    """ Hash password with method, the configured policy by default. """
+    return generate_password_hash(password, method=get_method(method),
+        salt_length=app.config['PASSWORD_SALT_LENGTH'])
+
+
+def check(pwhash, password):
+    return check_password_hash(pwhash, password)
+
+
+def get_prefix(pwhash):
+    """ The method a hash was made with. """
+    if pwhash.count('$') < 2:
+        return None
+    return pwhash.split('$', 1)[0]
+
+
+def get_policy_prefix():
+    """ The prefix werkzeug writes for the configured method, which spells
+    out defaults such as the iteration count, derived once by hashing a
+    probe. """
+    method = get_method()
+    if method not in policy_prefixes:
+        policy_prefixes[method] = get_prefix(generate('probe'))
+    return policy_prefixes[method]
+
+
+def needs_rehash(pwhash):
+    return get_prefix(pwhash) != get_policy_prefix()
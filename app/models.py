@@ -6,28 +6,38 @@ Author: huxuan
 Email: i(at)huxuan.org
 Description: Models for FangMi API.
 """
-import sys
-sys.path.insert(0, 'Flask-WhooshAlchemy')
-import flask_whooshalchemy as whooshalchemy
-
+from collections import OrderedDict
 from datetime import date
 from datetime import datetime
 from datetime import timedelta
-import operator
+import math
 import random
 
 from sqlalchemy import and_
+from sqlalchemy import event
+from sqlalchemy import false
+from sqlalchemy import inspect
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import AbstractConcreteBase
 from sqlalchemy.ext.declarative import ConcreteBase
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm import validates
 from werkzeug import datastructures
-from werkzeug.security import check_password_hash
-from werkzeug.security import generate_password_hash
 
 from app import app
+from app import cache
 from app import db
+from app import hashing
+from app import notifier
+from app import search
 from app import utils
 
 
+# Squared degrees under which two distances are considered equal.
+DISTANCE_TOLERANCE = 1e-12
+
+
 schools_communities = db.Table('schools_communities',
     db.Column('school_id', db.Integer, db.ForeignKey('schools.id')),
     db.Column('community_id', db.Integer, db.ForeignKey('communities.id')),
@@ -46,8 +56,36 @@ users_fav_apartments = db.Table('users_fav_apartments',
 )
 
 
+token_cache = cache.create('token',
+    ttl=app.config['TOKEN_CACHE_TTL'],
+    max_size=app.config['TOKEN_CACHE_SIZE'],
+)
+
+
+def snapshot(instance):
+    """ Column values of instance which can be restored without a query.
+
+    Columns listed in `__uncached__` change too often, or are too sensitive,
+    to be cached, they are left unloaded and fetched from the database when
+    accessed.
+    """
+    uncached = getattr(instance, '__uncached__', ())
+    return dict((column.name, getattr(instance, column.name))
+        for column in instance.__table__.columns
+        if column.name not in uncached)
+
+
+def restore(cls, values):
+    """ Attach an instance built from a snapshot to the current session. """
+    instance = cls(**values)
+    make_transient_to_detached(instance)
+    return db.session.merge(instance, load=False)
+
+
 class User(db.Model):
     __tablename__ = 'users'
+    __uncached__ = ('num_fav_apartments', 'num_unread_messages',
+        'password_hash', 'real_name', 'id_number')
 
     # Authentication related.
     username = db.Column(db.String(128), primary_key=True)
@@ -74,6 +112,10 @@ class User(db.Model):
     is_confirmed = db.Column(db.Boolean, default=False)
     is_student = db.Column(db.Boolean, default=False)
 
+    # Counters, maintained transactionally and by update_counters.
+    num_fav_apartments = db.Column(db.Integer, default=0)
+    num_unread_messages = db.Column(db.Integer, default=0)
+
     created_at = db.Column(db.DateTime, default=datetime.now)
     deleted = db.Column(db.Boolean, default=False)
 
@@ -96,7 +138,7 @@ class User(db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hashing.generate(password)
 
     @property
     def avatar(self):
@@ -128,21 +170,9 @@ class User(db.Model):
         self.pic_portal_md5 = utils.save_file(stream,
             app.config['UPLOAD_PIC_PORTAL_FOLDER'])
 
-    @property
-    def num_fav_apartments(self):
-        return self.fav_apartment_list.count()
-
-    @property
-    def num_unread_messages(self):
-        return Message.query.filter_by(
-            to_username=self.username,
-            unread=True,
-            deleted=False,
-        ).count()
-
     @property
     def fav_apartments(self):
-        return [apartment.serialize() for apartment in self.fav_apartment_list]
+        return Apartment.serialize_list(self.fav_apartment_list.all())
 
     @fav_apartments.setter
     def fav_apartments(self, fav_apartments):
@@ -191,6 +221,21 @@ class User(db.Model):
             raise utils.APIException(utils.API_CODE_USER_NOT_FOUND)
         return res
 
+    @classmethod
+    def get_many(cls, usernames, filter_deleted=True):
+        """ Users of usernames with one IN query, in the order asked, and the
+        usernames not found. """
+        users = {}
+        if usernames:
+            res = cls.query.filter(cls.username.in_(set(usernames)))
+            if filter_deleted:
+                res = res.filter_by(deleted=False)
+            users = dict((user.username, user) for user in res.all())
+        return (
+            [users[username] for username in usernames if username in users],
+            [username for username in usernames if username not in users],
+        )
+
     @classmethod
     def gets(cls, filter_deleted=True, limit=10):
         res = cls.query
@@ -210,13 +255,18 @@ class User(db.Model):
             if kwargs[key] is not None:
                 setattr(self, key, kwargs[key])
         db.session.flush()
+        Token.invalidate(self.username)
 
     def change_password(self, password):
         self.password = password
         db.session.flush()
+        Token.invalidate(self.username)
 
     def verify_password(self, password):
-        if check_password_hash(self.password_hash, password):
+        if hashing.check(self.password_hash, password):
+            if hashing.needs_rehash(self.password_hash):
+                self.password = password
+                db.session.commit()
             return True
         else:
             raise utils.APIException(utils.API_CODE_PASSWORD_INVALID)
@@ -224,11 +274,15 @@ class User(db.Model):
     def append_fav_apartment(self, apartment):
         if not self.is_fav_apartment(apartment.id):
             self.fav_apartment_list.append(apartment)
+            self.num_fav_apartments = User.num_fav_apartments + 1
+            apartment.num_fav_users = Apartment.num_fav_users + 1
         db.session.commit()
 
     def remove_fav_apartment(self, apartment):
         if self.is_fav_apartment(apartment.id):
             self.fav_apartment_list.remove(apartment)
+            self.num_fav_apartments = User.num_fav_apartments - 1
+            apartment.num_fav_users = Apartment.num_fav_users - 1
         db.session.commit()
 
     def fav_apartment_action(self, apartment_id, action):
@@ -251,32 +305,60 @@ class User(db.Model):
         ).count()
 
     def get_conversion(self):
-        conversation_list = {}
-        for to_username, max_id in Message.query.with_entities(
+        conversations = Conversation.gets(self.username)
+        return Conversation.serialize_list(conversations, self.username)
+
+    @classmethod
+    def update_counters(cls, usernames=None):
+        """ Recompute num_fav_apartments and num_unread_messages, for the given
+        users or for all users. """
+        if usernames is not None and not usernames:
+            return
+        res = db.session.query(
+                users_fav_apartments.c.username,
+                db.func.count(users_fav_apartments.c.apartment_id),
+            )
+        if usernames is not None:
+            res = res.filter(users_fav_apartments.c.username.in_(usernames))
+        num_fav_apartments = dict(
+            res.group_by(users_fav_apartments.c.username).all())
+        res = db.session.query(
                 Message.to_username,
-                db.func.max(Message.id)
-            ).filter_by(from_username=self.username
-            ).group_by(Message.to_username).all():
-            conversation_list[to_username] = max(
-                conversation_list.get(to_username, 0), max_id)
-        for from_username, max_id in Message.query.with_entities(
-                Message.from_username,
-                db.func.max(Message.id)
-            ).filter_by(to_username=self.username
-            ).group_by(Message.from_username).all():
-            conversation_list[from_username] = max(
-                conversation_list.get(from_username, 0), max_id)
-        conversation_list = sorted(conversation_list.items(),
-            key=operator.itemgetter(1), reverse=True)
-        return [{
-            'user': User.get(username).serialize(),
-            'message': Message.get(message_id).serialize(),
-            'num_unread': self.get_num_unread_from_username(username),
-        } for username, message_id in conversation_list]
+                db.func.count(Message.id),
+            ).filter_by(unread=True, deleted=False)
+        if usernames is not None:
+            res = res.filter(Message.to_username.in_(usernames))
+        num_unread_messages = dict(res.group_by(Message.to_username).all())
+        if usernames is None:
+            usernames = [username for username, in
+                db.session.query(cls.username).all()]
+        if usernames:
+            db.session.execute(cls.__table__.update().where(
+                cls.__table__.c.username == db.bindparam('b_username')).values(
+                num_fav_apartments=db.bindparam('b_num_fav_apartments'),
+                num_unread_messages=db.bindparam('b_num_unread_messages'),
+            ), [dict(
+                b_username=username,
+                b_num_fav_apartments=num_fav_apartments.get(username, 0),
+                b_num_unread_messages=num_unread_messages.get(username, 0),
+            ) for username in usernames])
+        db.session.expire_all()
 
+    @classmethod
+    def serialize_list(cls, users, fields=None, expand=None):
+        return [user.serialize(fields=fields, expand=expand) for user in users]
 
-    def serialize(self):
-        res = dict(
+    @classmethod
+    def serialize_dict(cls, usernames, fields=None, expand=None):
+        """ Map usernames to serialized users with one IN query. """
+        users = cls.query.filter(cls.username.in_(usernames)).all()
+        return dict(zip(
+            [user.username for user in users],
+            cls.serialize_list(users, fields=fields, expand=expand),
+        ))
+
+    def serialize(self, fields=None, expand=None):
+        return utils.select_fields(dict(
             username=self.username,
             nickname=self.nickname,
             avatar=self.avatar,
@@ -285,8 +367,8 @@ class User(db.Model):
             horoscope=self.horoscope,
             gender=self.gender,
             mobile=self.mobile,
-            num_fav_apartments=self.num_fav_apartments,
-            num_unread_messages=self.num_unread_messages,
+            num_fav_apartments=lambda: self.num_fav_apartments,
+            num_unread_messages=lambda: self.num_unread_messages,
             is_confirmed=self.is_confirmed,
             is_student=self.is_student,
             #fav_apartments=self.fav_apartments,
@@ -301,8 +383,7 @@ class User(db.Model):
             # Real name confirm information.
             real_name=self.real_name,
             id_number=self.id_number,
-        )
-        return res
+        ), fields)
 
 
 class School(db.Model):
@@ -355,14 +436,19 @@ class School(db.Model):
 
     @property
     def num_apartments(self):
-        community_ids = [community.id
-            for community in self.community_list]
-        if community_ids:
-            res = Apartment.query.filter(
-                Apartment.community_id.in_(community_ids))
-        else:
-            return 0
-        return res.count()
+        return self.count_apartments([self.id]).get(self.id, 0)
+
+    @classmethod
+    def count_apartments(cls, school_ids):
+        """ Map school ids to the number of apartments in their communities
+        with one grouped query. """
+        return dict(db.session.query(
+                schools_communities.c.school_id,
+                db.func.count(db.distinct(Apartment.id)),
+            ).join(Apartment,
+                Apartment.community_id == schools_communities.c.community_id,
+            ).filter(schools_communities.c.school_id.in_(school_ids)
+            ).group_by(schools_communities.c.school_id).all())
 
     @classmethod
     def create(cls, name, avatar, image):
@@ -394,7 +480,7 @@ class School(db.Model):
 
     @classmethod
     def search(cls, q, filter_deleted=True):
-        res = cls.query.whoosh_search(q)
+        res = search.search(cls.query, cls, q)
         if filter_deleted:
             res = res.filter_by(deleted=False)
         return res.all()
@@ -426,17 +512,34 @@ class School(db.Model):
         return self.community_list.filter(
             schools_communities.c.community_id == community_id).count() > 0
 
-    def serialize(self):
-        return dict(
+    @classmethod
+    def serialize_list(cls, schools, fields=None, expand=None):
+        """ Serialize schools with one grouped apartment count query. """
+        school_ids = list(set(school.id for school in schools))
+        if not school_ids:
+            return []
+        num_apartments = {}
+        if utils.is_selected('num_apartments', fields):
+            num_apartments = cls.count_apartments(school_ids)
+        return [school.serialize(
+            num_apartments=num_apartments.get(school.id, 0),
+            fields=fields,
+            expand=expand,
+        ) for school in schools]
+
+    def serialize(self, num_apartments=None, fields=None, expand=None):
+        if num_apartments is None:
+            num_apartments = lambda: self.num_apartments
+        return utils.select_fields(dict(
             id=self.id,
             name=self.name,
             avatar=self.avatar,
             image=self.image,
             #communities=self.communities,
-            num_apartments=self.num_apartments,
+            num_apartments=num_apartments,
             created_at=self.created_at.isoformat(),
             deleted=self.deleted,
-        )
+        ), fields)
 
 
 class Community(db.Model):
@@ -449,7 +552,11 @@ class Community(db.Model):
     address = db.Column(db.String(255))
     traffic = db.Column(db.String(255))
     funmi_community_id = db.Column(db.String(32))
+    # "lng,lat", parsed into longitude, latitude and geohash on assignment.
     location = db.Column(db.String(255))
+    longitude = db.Column(db.Float)
+    latitude = db.Column(db.Float)
+    geohash = db.Column(db.String(utils.GEOHASH_PRECISION), index=True)
     map_md5 = db.Column(db.String(32))
 
     created_at = db.Column(db.DateTime, default=datetime.now)
@@ -458,6 +565,19 @@ class Community(db.Model):
     apartment_list = db.relationship('Apartment', backref='community',
         lazy='dynamic')
 
+    # Squared distance in degrees, set by nearby queries.
+    distance = None
+
+    @validates('location')
+    def validate_location(self, key, location):
+        try:
+            self.longitude, self.latitude = utils.location_type(location)
+            self.geohash = utils.geohash_encode(self.longitude,
+                self.latitude)
+        except (AttributeError, ValueError):
+            self.longitude = self.latitude = self.geohash = None
+        return location
+
     @property
     def map(self):
         return utils.get_url_from_md5(app.config['UPLOAD_COMMUNITY_MAP_URL'],
@@ -470,7 +590,7 @@ class Community(db.Model):
 
     @property
     def schools(self):
-        return [school.serialize() for school in self.school_list]
+        return School.serialize_list(self.school_list.all())
 
     @schools.setter
     def schools(self, schools):
@@ -479,7 +599,7 @@ class Community(db.Model):
 
     @property
     def apartments(self):
-        return [apartment.serialize() for apartment in self.apartment_list]
+        return Apartment.serialize_list(self.apartment_list.all())
 
     @property
     def num_apartments(self):
@@ -519,11 +639,47 @@ class Community(db.Model):
 
     @classmethod
     def search(cls, q, filter_deleted=True):
-        res = cls.query.whoosh_search(q)
+        res = search.search(cls.query, cls, q)
         if filter_deleted:
             res = res.filter_by(deleted=False)
         return res.all()
 
+    @classmethod
+    def nearby_filter(cls, near, radius=None):
+        """ Criterion for communities within radius km of near, and their
+        squared distance in degrees to order by.
+
+        The geohash prefixes narrow the candidates down by index, the
+        equirectangular distance only needs arithmetic, so it runs on both
+        MySQL and SQLite.
+        """
+        longitude, latitude = near
+        if not radius or radius <= 0:
+            radius = app.config['NEARBY_DEFAULT_RADIUS_KM']
+        radius = min(radius, app.config['NEARBY_MAX_RADIUS_KM'])
+        cos_latitude = math.cos(math.radians(latitude))
+        dx = (cls.longitude - longitude) * cos_latitude
+        dy = cls.latitude - latitude
+        distance = dx * dx + dy * dy
+        criterion = and_(
+            or_(*[cls.geohash.like(cell + '%')
+                for cell in utils.geohash_cells(longitude, latitude, radius)]),
+            distance <= (radius / utils.KM_PER_DEGREE) ** 2,
+        )
+        return criterion, distance
+
+    @classmethod
+    def nearby(cls, near, radius=None, limit=10, filter_deleted=True):
+        """ Communities within radius km of near, nearest first. """
+        criterion, distance = cls.nearby_filter(near, radius)
+        res = db.session.query(cls, distance).filter(criterion)
+        if filter_deleted:
+            res = res.filter(cls.deleted == False)
+        res = res.order_by(distance, cls.id).limit(limit).all()
+        for community, community_distance in res:
+            community.distance = community_distance
+        return [community for community, _ in res]
+
     def set(self, **kwargs):
         for key in kwargs:
             if kwargs[key] is not None:
@@ -551,8 +707,56 @@ class Community(db.Model):
         return self.school_list.filter(
             schools_communities.c.school_id == school_id).count() > 0
 
-    def serialize(self):
-        return dict(
+    @classmethod
+    def serialize_list(cls, communities, fields=None, expand=None):
+        """ Serialize communities with one query per relationship. """
+        community_ids = list(set(community.id for community in communities))
+        if not community_ids:
+            return []
+        community_schools = {}
+        if utils.is_expanded('schools', fields, expand):
+            school_rows = db.session.query(
+                    schools_communities.c.community_id,
+                    School,
+                ).join(School, School.id == schools_communities.c.school_id
+                ).filter(schools_communities.c.community_id.in_(community_ids)
+                ).order_by(School.id).all()
+            schools = list(set(school for _, school in school_rows))
+            school_infos = dict(zip(
+                [school.id for school in schools],
+                School.serialize_list(schools,
+                    **utils.sub_fields('schools', fields, expand)),
+            ))
+            for community_id, school in school_rows:
+                community_schools.setdefault(community_id, []).append(
+                    school_infos[school.id])
+        elif utils.is_selected('schools', fields):
+            for community_id, school_id in db.session.query(
+                    schools_communities.c.community_id,
+                    schools_communities.c.school_id,
+                ).filter(schools_communities.c.community_id.in_(community_ids)
+                ).order_by(schools_communities.c.school_id).all():
+                community_schools.setdefault(community_id, []).append(
+                    school_id)
+        num_apartments = {}
+        if utils.is_selected('num_apartments', fields):
+            num_apartments = dict(db.session.query(
+                    Apartment.community_id,
+                    db.func.count(Apartment.id),
+                ).filter(Apartment.community_id.in_(community_ids)
+                ).group_by(Apartment.community_id).all())
+        return [community.serialize(
+            schools=community_schools.get(community.id, []),
+            num_apartments=num_apartments.get(community.id, 0),
+            fields=fields,
+            expand=expand,
+        ) for community in communities]
+
+    def serialize(self, schools=None, num_apartments=None, fields=None,
+        expand=None):
+        if num_apartments is None:
+            num_apartments = lambda: self.num_apartments
+        values = dict(
             id=self.id,
             name=self.name,
             address=self.address,
@@ -560,17 +764,34 @@ class Community(db.Model):
             funmi_community_id=self.funmi_community_id,
             location=self.location,
             map=self.map,
-            schools=self.schools,
             #apartments=self.apartments,
-            num_apartments=self.num_apartments,
+            num_apartments=num_apartments,
             created_at=self.created_at.isoformat(),
             deleted=self.deleted,
         )
+        if self.distance is not None:
+            values['distance'] = utils.distance_km(self.distance)
+        relations = {}
+        if schools is None:
+            relations['schools'] = (
+                lambda: [school.id for school in self.school_list],
+                lambda **kwargs: School.serialize_list(self.school_list.all(),
+                    **kwargs),
+            )
+        else:
+            values['schools'] = schools
+        return utils.select_fields(values, fields, expand, relations)
 
 
 class Apartment(db.Model):
     __tablename__ = 'apartments'
     __searchable__ = ['title', 'subtitle', 'address']
+    __table_args__ = (
+        db.Index('ix_apartment_deleted_cancelled_community_id_created_at_id',
+            'deleted', 'cancelled', 'community_id', 'created_at', 'id'),
+        db.Index('ix_apartment_deleted_cancelled_min_price_id',
+            'deleted', 'cancelled', 'min_price', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -587,6 +808,14 @@ class Apartment(db.Model):
     type = db.Column(db.SmallInteger)
     cancelled = db.Column(db.Boolean, default=False)
 
+    # Aggregates over rooms, maintained by update_prices.
+    min_price = db.Column(db.Integer)
+    max_price = db.Column(db.Integer)
+    num_rooms = db.Column(db.Integer, default=0)
+    # Counters, maintained transactionally and by update_counters.
+    num_fav_users = db.Column(db.Integer, default=0)
+    num_reserve = db.Column(db.Integer, default=0)
+
     created_at = db.Column(db.DateTime, default=datetime.now)
     deleted = db.Column(db.Boolean, default=False)
 
@@ -607,6 +836,9 @@ class Apartment(db.Model):
         lazy='dynamic',
     )
 
+    # Squared distance in degrees of the community, set by nearby queries.
+    distance = None
+
     @property
     def user_info(self):
         return self.user.serialize()
@@ -711,6 +943,8 @@ class Apartment(db.Model):
                     room['date_entrance'],
                 ) for room in rooms]
             db.session.commit()
+            Apartment.update_prices([self.id])
+            db.session.commit()
 
     @property
     def tags(self):
@@ -725,33 +959,19 @@ class Apartment(db.Model):
                 ) for tag in tags]
             db.session.commit()
 
-    @property
-    def num_fav_users(self):
-        return self.fav_users.count()
-
-    @property
-    def num_reserve(self):
-        return self.reserve_list.count()
-
-    @property
-    def min_price(self):
-        return min([room.price for room in self.room_list])
-
-    @property
-    def max_price(self):
-        return max([room.price for room in self.room_list])
-
     @property
     def status(self):
-        for room in self.room_list:
-            if room.status:
-                return True
-        return False
+        return db.session.query(self.room_list.filter(
+            Room.available_filter()).exists()).scalar()
 
     @classmethod
     def create(cls, username, community_id, title="", subtitle="", address="",
         num_bathroom=0, num_bedroom=0, num_livingroom=0, type=0, devices=[],
         reserve_choices=[], rooms=[], tags=[]):
+        """ Create an apartment with all its children in one transaction,
+        inserting each kind of child with a single executemany.
+        """
+        prices = [room['price'] for room in rooms or []]
         apartment = cls(
             username=username,
             community_id=community_id,
@@ -762,12 +982,21 @@ class Apartment(db.Model):
             num_bedroom=num_bedroom,
             num_livingroom=num_livingroom,
             type=type,
-            devices=devices,
-            reserve_choices=reserve_choices,
-            rooms=rooms,
-            tags=tags,
+            min_price=min(prices) if prices else None,
+            max_price=max(prices) if prices else None,
+            num_rooms=len(prices),
         )
         db.session.add(apartment)
+        db.session.flush()
+        Device.bulk_create(apartment.id, devices)
+        ReserveChoice.bulk_create(apartment.id, reserve_choices)
+        Room.bulk_create(apartment.id, rooms)
+        tag_ids = Tag.bulk_create([tag['name'] for tag in tags or []])
+        if tag_ids:
+            db.session.execute(apartments_tags.insert(), [dict(
+                apartment_id=apartment.id,
+                tag_id=tag_id,
+            ) for tag_id in tag_ids])
         db.session.commit()
         return apartment
 
@@ -783,29 +1012,185 @@ class Apartment(db.Model):
 
     @classmethod
     def gets(cls, username=None, community_id=None, school_id=None,
-        q=None, filter_cancelled=True, filter_deleted=True, limit=10):
+        q=None, filter_cancelled=True, filter_deleted=True, limit=10,
+        cursor=None, after_id=None, price_min=None, price_max=None,
+        sort=None, near=None, radius=None):
+        """ Apartments paginated by keyset, ordered by newest first or, with
+        `sort='price'`, by the lowest room price of apartments with rooms.
+
+        With `near` only apartments whose community is within `radius` km
+        are returned, nearest first unless another sort is given.
+
+        Pass `cursor` from the previous page (see `get_cursor`) or the id of
+        the last apartment seen as `after_id` to fetch the next page.
+        """
         res = cls.query
         if username:
             res = res.filter_by(username=username)
         if community_id:
             res = res.filter_by(community_id=community_id)
         if school_id:
-            school = School.get(school_id)
-            community_ids = [community.id
-                for community in school.community_list]
-            res = res.filter(Apartment.community_id.in_(community_ids))
+            School.get(school_id)
+            res = res.filter(Apartment.community_id.in_(
+                db.select([schools_communities.c.community_id]).where(
+                    schools_communities.c.school_id == school_id)))
         if q:
-            res = res.whoosh_search(q)
+            # NOTE: Keyset pagination needs a stable order, so relevance
+            # ordering from search is replaced by the sort order.
+            res = search.search(res, cls, q).order_by(None)
+        if price_min is not None:
+            res = res.filter(Apartment.min_price >= price_min)
+        if price_max is not None:
+            res = res.filter(Apartment.min_price <= price_max)
         if filter_cancelled:
             res = res.filter_by(cancelled=False)
         if filter_deleted:
             res = res.filter_by(deleted=False)
-        res = res.limit(limit).all()
-        return res
+        distance = None
+        if near:
+            criterion, distance = Community.nearby_filter(near, radius)
+            res = res.join(Community,
+                Apartment.community_id == Community.id).filter(criterion)
+            sort = sort or 'distance'
+        if after_id:
+            after = cls.get(after_id, filter_deleted=False)
+            if distance is not None:
+                after.distance = db.session.query(distance).filter(
+                    Community.id == after.community_id).scalar()
+            cursor = cls.get_cursor(after, sort=sort)
+        if sort == 'distance':
+            if distance is None:
+                raise utils.APIException(utils.API_CODE_REQUIRED,
+                    name='near')
+            if cursor:
+                # NOTE: The database driver may round the float parameter,
+                # so apartments of the same community are matched by a tiny
+                # tolerance instead of equality.
+                key, id = utils.decode_cursor(cursor, float)
+                res = res.filter(or_(
+                    distance > key + DISTANCE_TOLERANCE,
+                    and_(distance >= key - DISTANCE_TOLERANCE,
+                        Apartment.id > id),
+                ))
+            res = res.order_by(distance, Apartment.id)
+        elif sort == 'price':
+            # NOTE: Apartments without rooms have no min_price and are left
+            # out, so that the order is served by the index on
+            # (min_price, id). A cursor past one of them has nothing after.
+            res = res.filter(Apartment.min_price != None)
+            if cursor:
+                min_price, id = utils.decode_cursor(cursor, int,
+                    nullable=True)
+                if min_price is None:
+                    res = res.filter(false())
+                else:
+                    res = res.filter(or_(
+                        Apartment.min_price > min_price,
+                        and_(Apartment.min_price == min_price,
+                            Apartment.id > id),
+                    ))
+            res = res.order_by(Apartment.min_price, Apartment.id)
+        else:
+            if cursor:
+                created_at, id = utils.decode_cursor(cursor)
+                res = res.filter(or_(
+                    Apartment.created_at < created_at,
+                    and_(Apartment.created_at == created_at,
+                        Apartment.id < id),
+                ))
+            res = res.order_by(Apartment.created_at.desc(),
+                Apartment.id.desc())
+        if distance is None:
+            return res.limit(limit).all()
+        res = res.add_columns(distance).limit(limit).all()
+        for apartment, apartment_distance in res:
+            apartment.distance = apartment_distance
+        return [apartment for apartment, _ in res]
+
+    @classmethod
+    def get_cursor(cls, apartment, sort=None):
+        if sort == 'distance':
+            return utils.encode_cursor(repr(apartment.distance), apartment.id)
+        if sort == 'price':
+            return utils.encode_cursor(apartment.min_price, apartment.id)
+        return utils.encode_cursor(apartment.created_at, apartment.id)
+
+    @classmethod
+    def update_prices(cls, apartment_ids=None):
+        """ Recompute min_price, max_price and num_rooms from rooms, for the
+        given apartments or for all apartments. """
+        if apartment_ids is not None and not apartment_ids:
+            return
+        res = db.session.query(
+                Room.apartment_id,
+                db.func.min(Room.price),
+                db.func.max(Room.price),
+                db.func.count(Room.id),
+            )
+        if apartment_ids is not None:
+            res = res.filter(Room.apartment_id.in_(apartment_ids))
+        summaries = dict((row[0], row[1:])
+            for row in res.group_by(Room.apartment_id).all())
+        if apartment_ids is None:
+            apartment_ids = [id for id, in db.session.query(cls.id).all()]
+        params = []
+        for apartment_id in apartment_ids:
+            min_price, max_price, num_rooms = summaries.get(apartment_id,
+                (None, None, 0))
+            params.append(dict(
+                apartment_id=apartment_id,
+                b_min_price=min_price,
+                b_max_price=max_price,
+                b_num_rooms=num_rooms,
+            ))
+        if params:
+            db.session.execute(cls.__table__.update().where(
+                cls.__table__.c.id == db.bindparam('apartment_id')).values(
+                min_price=db.bindparam('b_min_price'),
+                max_price=db.bindparam('b_max_price'),
+                num_rooms=db.bindparam('b_num_rooms'),
+            ), params)
+        db.session.expire_all()
+
+    @classmethod
+    def update_counters(cls, apartment_ids=None):
+        """ Recompute num_fav_users and num_reserve, for the given apartments
+        or for all apartments. """
+        if apartment_ids is not None and not apartment_ids:
+            return
+        res = db.session.query(
+                users_fav_apartments.c.apartment_id,
+                db.func.count(users_fav_apartments.c.username),
+            )
+        if apartment_ids is not None:
+            res = res.filter(
+                users_fav_apartments.c.apartment_id.in_(apartment_ids))
+        num_fav_users = dict(
+            res.group_by(users_fav_apartments.c.apartment_id).all())
+        res = db.session.query(
+                Reserve.apartment_id,
+                db.func.count(Reserve.id),
+            )
+        if apartment_ids is not None:
+            res = res.filter(Reserve.apartment_id.in_(apartment_ids))
+        num_reserve = dict(res.group_by(Reserve.apartment_id).all())
+        if apartment_ids is None:
+            apartment_ids = [id for id, in db.session.query(cls.id).all()]
+        if apartment_ids:
+            db.session.execute(cls.__table__.update().where(
+                cls.__table__.c.id == db.bindparam('b_id')).values(
+                num_fav_users=db.bindparam('b_num_fav_users'),
+                num_reserve=db.bindparam('b_num_reserve'),
+            ), [dict(
+                b_id=apartment_id,
+                b_num_fav_users=num_fav_users.get(apartment_id, 0),
+                b_num_reserve=num_reserve.get(apartment_id, 0),
+            ) for apartment_id in apartment_ids])
+        db.session.expire_all()
 
     @classmethod
     def search(cls, q, filter_deleted=True):
-        res = cls.query.whoosh_search(q)
+        res = search.search(cls.query, cls, q)
         if filter_deleted:
             res = res.filter_by(deleted=False)
         return res.all()
@@ -822,40 +1207,169 @@ class Apartment(db.Model):
                 name=self.__tablename__)
         return True
 
-    def serialize(self, oauth_user=None):
-        res = dict(
-            id=self.id,
-            user=self.user_info,
-            community=self.community_info,
-            title=self.title,
-            subtitle=self.subtitle,
-            address=self.address,
-            contract=self.contract,
-            num_bathroom=self.num_bathroom,
-            num_bedroom=self.num_bedroom,
-            num_livingroom=self.num_livingroom,
-            num_fav_users=self.num_fav_users,
-            num_reserve=self.num_reserve,
-            min_price=self.min_price,
-            max_price=self.max_price,
-            status=self.status,
-            cancelled=self.cancelled,
-            type=self.type,
-            comments=self.comments,
-            devices=self.devices,
-            photos=self.photos,
-            reserve_choices=self.reserve_choices,
-            rooms=self.rooms,
-            tags=self.tags,
-            created_at=self.created_at.isoformat(),
-            deleted=self.deleted,
-        )
-        if oauth_user:
-            res.update(dict(
-                is_favorited=oauth_user.is_fav_apartment(self.id),
+    @classmethod
+    def serialize_list(cls, apartments, oauth_user=None, fields=None,
+        expand=None):
+        """ Serialize apartments with one IN query per relationship.
+
+        The result is the same as calling ``serialize`` for each apartment,
+        but the number of queries does not grow with the number of
+        apartments, rooms, rents or comments. Relationships left out by
+        `fields` or `expand` are not queried at all.
+        """
+        apartment_ids = list(set(apartment.id for apartment in apartments))
+        if not apartment_ids:
+            return []
+
+        user_infos = {}
+        if utils.is_expanded('user', fields, expand):
+            user_infos = User.serialize_dict(
+                list(set(apartment.username for apartment in apartments)),
+                **utils.sub_fields('user', fields, expand))
+
+        community_infos = {}
+        if utils.is_expanded('community', fields, expand):
+            community_ids = list(set(apartment.community_id
+                for apartment in apartments))
+            communities = Community.query.filter(
+                Community.id.in_(community_ids)).all()
+            community_infos = dict(zip(
+                [community.id for community in communities],
+                Community.serialize_list(communities,
+                    **utils.sub_fields('community', fields, expand)),
             ))
+
+        comment_infos = {}
+        if utils.is_selected('comments', fields):
+            comments = Comment.query.filter(
+                Comment.apartment_id.in_(apartment_ids)
+                ).order_by(Comment.id).all()
+            comment_infos = utils.group_by(comments,
+                Comment.serialize_list(comments,
+                    **utils.sub_fields('comments', fields, expand)),
+                'apartment_id')
+
+        device_infos = {}
+        if utils.is_selected('devices', fields):
+            devices = Device.query.filter(
+                Device.apartment_id.in_(apartment_ids)
+                ).order_by(Device.id).all()
+            device_infos = utils.group_by(devices,
+                [device.serialize(**utils.sub_fields('devices', fields,
+                    expand)) for device in devices], 'apartment_id')
+
+        photo_infos = {}
+        if utils.is_selected('photos', fields):
+            photos = Photo.query.filter(
+                Photo.apartment_id.in_(apartment_ids)
+                ).order_by(Photo.id).all()
+            photo_infos = utils.group_by(photos,
+                [photo.serialize(**utils.sub_fields('photos', fields,
+                    expand)) for photo in photos], 'apartment_id')
+
+        reserve_choice_infos = {}
+        if utils.is_selected('reserve_choices', fields):
+            reserve_choices = ReserveChoice.query.filter(
+                ReserveChoice.apartment_id.in_(apartment_ids)
+                ).order_by(ReserveChoice.id).all()
+            reserve_choice_infos = utils.group_by(reserve_choices,
+                [reserve_choice.serialize(**utils.sub_fields(
+                    'reserve_choices', fields, expand))
+                    for reserve_choice in reserve_choices],
+                'apartment_id')
+
+        room_infos = {}
+        room_status = set()
+        if utils.is_selected('rooms', fields) or \
+            utils.is_selected('status', fields):
+            rooms = Room.query.filter(
+                Room.apartment_id.in_(apartment_ids)).order_by(Room.id).all()
+            room_infos = utils.group_by(rooms,
+                [room.serialize(**utils.sub_fields('rooms', fields, expand))
+                    for room in rooms], 'apartment_id')
+            room_status = set(room.apartment_id for room in rooms
+                if room.status)
+
+        tag_infos = {}
+        if utils.is_selected('tags', fields):
+            tag_rows = db.session.query(
+                    apartments_tags.c.apartment_id,
+                    Tag,
+                ).join(Tag, Tag.id == apartments_tags.c.tag_id
+                ).filter(apartments_tags.c.apartment_id.in_(apartment_ids)
+                ).order_by(Tag.id).all()
+            for apartment_id, tag in tag_rows:
+                tag_infos.setdefault(apartment_id, []).append(
+                    tag.serialize(**utils.sub_fields('tags', fields, expand)))
+
+        fav_apartment_ids = set()
+        if oauth_user and utils.is_selected('is_favorited', fields):
+            fav_apartment_ids = set(apartment_id for apartment_id, in
+                db.session.query(users_fav_apartments.c.apartment_id).filter(
+                    users_fav_apartments.c.username == oauth_user.username,
+                    users_fav_apartments.c.apartment_id.in_(apartment_ids),
+                ).all())
+
+        res = []
+        for apartment in apartments:
+            values = dict(
+                id=apartment.id,
+                title=apartment.title,
+                subtitle=apartment.subtitle,
+                address=apartment.address,
+                contract=apartment.contract,
+                num_bathroom=apartment.num_bathroom,
+                num_bedroom=apartment.num_bedroom,
+                num_livingroom=apartment.num_livingroom,
+                num_fav_users=apartment.num_fav_users,
+                num_reserve=apartment.num_reserve,
+                num_rooms=apartment.num_rooms,
+                min_price=apartment.min_price,
+                max_price=apartment.max_price,
+                status=apartment.id in room_status,
+                cancelled=apartment.cancelled,
+                type=apartment.type,
+                comments=comment_infos.get(apartment.id, []),
+                devices=device_infos.get(apartment.id, []),
+                photos=photo_infos.get(apartment.id, []),
+                reserve_choices=reserve_choice_infos.get(apartment.id, []),
+                rooms=room_infos.get(apartment.id, []),
+                tags=tag_infos.get(apartment.id, []),
+                created_at=apartment.created_at.isoformat(),
+                deleted=apartment.deleted,
+            )
+            if oauth_user:
+                values.update(dict(
+                    is_favorited=apartment.id in fav_apartment_ids,
+                ))
+            if apartment.distance is not None:
+                values['distance'] = utils.distance_km(apartment.distance)
+            relations = dict(
+                user=(apartment.username,
+                    lambda username=apartment.username, **kwargs:
+                        user_infos.get(username)),
+                community=(apartment.community_id,
+                    lambda community_id=apartment.community_id, **kwargs:
+                        community_infos.get(community_id)),
+            )
+            res.append(utils.select_fields(values, fields, expand, relations))
         return res
 
+    @classmethod
+    def serialize_dict(cls, apartment_ids, oauth_user=None, fields=None,
+        expand=None):
+        """ Map ids to serialized apartments with serialize_list. """
+        apartments = cls.query.filter(cls.id.in_(apartment_ids)).all()
+        return dict(zip(
+            [apartment.id for apartment in apartments],
+            cls.serialize_list(apartments, oauth_user=oauth_user,
+                fields=fields, expand=expand),
+        ))
+
+    def serialize(self, oauth_user=None, fields=None, expand=None):
+        return self.serialize_list([self], oauth_user=oauth_user,
+            fields=fields, expand=expand)[0]
+
 
 class ReserveChoice(db.Model):
     __tablename__ = 'reserve_choices'
@@ -890,6 +1404,17 @@ class ReserveChoice(db.Model):
         db.session.commit()
         return reserve_choice
 
+    @classmethod
+    def bulk_create(cls, apartment_id, reserve_choices):
+        """ Insert reserve choices with one executemany, without commit. """
+        if reserve_choices:
+            db.session.execute(cls.__table__.insert(), [dict(
+                apartment_id=apartment_id,
+                date=reserve_choice['date'],
+                time_start=reserve_choice['time_start'],
+                time_end=reserve_choice['time_end'],
+            ) for reserve_choice in reserve_choices])
+
     @classmethod
     def get(cls, id, filter_deleted=True, nullable=False):
         res = cls.query.filter_by(id=id)
@@ -915,8 +1440,8 @@ class ReserveChoice(db.Model):
                 setattr(self, key, kwargs[key])
         db.session.flush()
 
-    def serialize(self):
-        return dict(
+    def serialize(self, fields=None, expand=None):
+        return utils.select_fields(dict(
             id=self.id,
             #apartment=self.apartment_info,
             date=self.date.isoformat(),
@@ -924,7 +1449,7 @@ class ReserveChoice(db.Model):
             time_end=self.time_end.isoformat(),
             created_at=self.created_at.isoformat(),
             deleted=self.deleted,
-        )
+        ), fields)
 
 
 class Room(db.Model):
@@ -938,6 +1463,8 @@ class Room(db.Model):
     name = db.Column(db.String(16), nullable=False)
     price = db.Column(db.Integer)
     date_entrance = db.Column(db.Date)
+    # The end of the rent covering today, maintained by update_availability.
+    occupied_until = db.Column(db.Date, index=True)
 
     created_at = db.Column(db.DateTime, default=datetime.now)
     deleted = db.Column(db.Boolean, default=False)
@@ -950,10 +1477,46 @@ class Room(db.Model):
 
     @property
     def status(self):
-        for rent in self.rent_list:
-            if rent.date_start <= date.today() and date.today() < rent.date_end:
-                return False
-        return True
+        return not self.occupied_until or self.occupied_until <= date.today()
+
+    @classmethod
+    def available_filter(cls):
+        return or_(cls.occupied_until == None,
+            cls.occupied_until <= date.today())
+
+    @classmethod
+    def update_availability(cls, room_ids=None):
+        """ Recompute occupied_until from the rents covering today, for the
+        given rooms or for all rooms. Run daily for all rooms so that rents
+        starting later take effect, see db_availability.py.
+        """
+        if room_ids is not None and not room_ids:
+            return
+        today = date.today()
+        res = db.session.query(
+                Rent.room_id,
+                db.func.max(Rent.date_end),
+            ).filter(
+                Rent.date_start <= today,
+                Rent.date_end > today,
+            ).filter_by(deleted=False)
+        if room_ids is not None:
+            res = res.filter(Rent.room_id.in_(room_ids))
+        occupied = dict(res.group_by(Rent.room_id).all())
+        res = cls.query.filter(cls.occupied_until != None)
+        if room_ids is not None:
+            res = res.filter(cls.id.in_(room_ids))
+        if occupied:
+            res = res.filter(~cls.id.in_(occupied.keys()))
+        res.update({cls.occupied_until: None}, synchronize_session=False)
+        if occupied:
+            db.session.execute(cls.__table__.update().where(
+                cls.__table__.c.id == db.bindparam('room_id')).values(
+                occupied_until=db.bindparam('date_end')), [dict(
+                    room_id=room_id,
+                    date_end=date_end,
+                ) for room_id, date_end in occupied.items()])
+        db.session.expire_all()
 
     @classmethod
     def create(cls, apartment_id, name, area, price, date_entrance):
@@ -965,9 +1528,23 @@ class Room(db.Model):
             date_entrance=date_entrance,
         )
         db.session.add(room)
+        db.session.flush()
+        Apartment.update_prices([apartment_id])
         db.session.commit()
         return room
 
+    @classmethod
+    def bulk_create(cls, apartment_id, rooms):
+        """ Insert rooms with one executemany, without commit. """
+        if rooms:
+            db.session.execute(cls.__table__.insert(), [dict(
+                apartment_id=apartment_id,
+                name=room['name'],
+                area=room['area'],
+                price=room['price'],
+                date_entrance=room['date_entrance'],
+            ) for room in rooms])
+
     @classmethod
     def get(cls, id, filter_deleted=True, nullable=False):
         res = cls.query.filter_by(id=id)
@@ -980,13 +1557,15 @@ class Room(db.Model):
         return res
 
     def set(self, **kwargs):
+        apartment_ids = [self.apartment_id]
         for key in kwargs:
             if kwargs[key] is not None:
                 setattr(self, key, kwargs[key])
         db.session.flush()
+        Apartment.update_prices(list(set(apartment_ids + [self.apartment_id])))
 
-    def serialize(self):
-        return dict(
+    def serialize(self, fields=None, expand=None):
+        return utils.select_fields(dict(
             id=self.id,
             #apartment=self.apartment_info,
             area=self.area,
@@ -996,7 +1575,7 @@ class Room(db.Model):
             date_entrance=self.date_entrance.isoformat(),
             created_at=self.created_at.isoformat(),
             deleted=self.deleted,
-        )
+        ), fields)
 
 
 class Device(db.Model):
@@ -1027,21 +1606,31 @@ class Device(db.Model):
         db.session.commit()
         return room
 
+    @classmethod
+    def bulk_create(cls, apartment_id, devices):
+        """ Insert devices with one executemany, without commit. """
+        if devices:
+            db.session.execute(cls.__table__.insert(), [dict(
+                apartment_id=apartment_id,
+                name=device['name'],
+                count=device.get('count', None),
+            ) for device in devices])
+
     def set(self, **kwargs):
         for key in kwargs:
             if kwargs[key] is not None:
                 setattr(self, key, kwargs[key])
         db.session.flush()
 
-    def serialize(self):
-        return dict(
+    def serialize(self, fields=None, expand=None):
+        return utils.select_fields(dict(
             id=self.id,
             #apartment=self.apartment_info,
             name=self.name,
             count=self.count,
             created_at=self.created_at.isoformat(),
             deleted=self.deleted,
-        )
+        ), fields)
 
 
 class Photo(db.Model):
@@ -1086,14 +1675,14 @@ class Photo(db.Model):
                 setattr(self, key, kwargs[key])
         db.session.flush()
 
-    def serialize(self):
-        return dict(
+    def serialize(self, fields=None, expand=None):
+        return utils.select_fields(dict(
             id=self.id,
             #apartment=self.apartment_info,
             photo=self.photo,
             created_at=self.created_at.isoformat(),
             deleted=self.deleted,
-        )
+        ), fields)
 
 
 class Tag(db.Model):
@@ -1108,7 +1697,7 @@ class Tag(db.Model):
 
     @property
     def apartments(self):
-        return [apartment.serialize() for apartment in self.apartment_list]
+        return Apartment.serialize_list(self.apartment_list.all())
 
     @classmethod
     def get(cls, name):
@@ -1125,20 +1714,45 @@ class Tag(db.Model):
             db.session.commit()
         return tag
 
+    @classmethod
+    def bulk_create(cls, names):
+        """ Return ids of tags with the given names, inserting the missing
+        ones with one executemany, without commit.
+        """
+        names = list(OrderedDict.fromkeys(names))
+        if not names:
+            return []
+        # NOTE: Names are compared case insensitively like the database does.
+        tag_ids = dict((name.lower(), id) for name, id in
+            db.session.query(cls.name, cls.id).filter(
+                cls.name.in_(names)).all())
+        missing_names = [name for name in names
+            if name.lower() not in tag_ids]
+        if missing_names:
+            db.session.execute(cls.__table__.insert(), [dict(
+                name=name,
+            ) for name in OrderedDict((name.lower(), name)
+                for name in missing_names).values()])
+            tag_ids.update((name.lower(), id) for name, id in
+                db.session.query(cls.name, cls.id).filter(
+                    cls.name.in_(missing_names)).all())
+        return list(OrderedDict.fromkeys(tag_ids[name.lower()]
+            for name in names if name.lower() in tag_ids))
+
     def set(self, **kwargs):
         for key in kwargs:
             if kwargs[key] is not None:
                 setattr(self, key, kwargs[key])
         db.session.flush()
 
-    def serialize(self):
-        return dict(
+    def serialize(self, fields=None, expand=None):
+        return utils.select_fields(dict(
             id=self.id,
             name=self.name,
             #apartments=self.apartments,
             created_at=self.created_at.isoformat(),
             deleted=self.deleted,
-        )
+        ), fields)
 
 
 class Rent(db.Model):
@@ -1186,6 +1800,8 @@ class Rent(db.Model):
             date_end=date_end,
         )
         db.session.add(rent)
+        db.session.flush()
+        Room.update_availability([room_id])
         db.session.commit()
         return rent
 
@@ -1211,27 +1827,64 @@ class Rent(db.Model):
         return res.all()
 
     def set(self, **kwargs):
+        room_ids = [self.room_id]
         for key in kwargs:
             if kwargs[key] is not None:
                 setattr(self, key, kwargs[key])
         db.session.flush()
+        Room.update_availability(list(set(room_ids + [self.room_id])))
 
     def verify_owner(self, username):
         if self.username != username and self.apartment.username != username:
             raise utils.APIException(utils.API_CODE_NOT_AUTHORIZED,
                 name=self.__tablename__)
 
-    def serialize(self):
-        return dict(
+    @classmethod
+    def serialize_list(cls, rents, fields=None, expand=None):
+        """ Serialize rents with one IN query per expanded relationship. """
+        if not rents:
+            return []
+        user_infos = {}
+        if utils.is_expanded('user', fields, expand):
+            user_infos = User.serialize_dict(
+                list(set(rent.username for rent in rents)),
+                **utils.sub_fields('user', fields, expand))
+        apartment_infos = {}
+        if utils.is_expanded('apartment', fields, expand):
+            apartment_infos = Apartment.serialize_dict(
+                list(set(rent.apartment_id for rent in rents)),
+                **utils.sub_fields('apartment', fields, expand))
+        room_infos = {}
+        if utils.is_expanded('room', fields, expand):
+            rooms = Room.query.filter(Room.id.in_(
+                list(set(rent.room_id for rent in rents)))).all()
+            room_infos = dict((room.id, room.serialize(
+                **utils.sub_fields('room', fields, expand)))
+                for room in rooms)
+        return [rent.serialize(
+            user=user_infos.get(rent.username),
+            apartment=apartment_infos.get(rent.apartment_id),
+            room=room_infos.get(rent.room_id),
+            fields=fields,
+            expand=expand,
+        ) for rent in rents]
+
+    def serialize(self, user=None, apartment=None, room=None, fields=None,
+        expand=None):
+        return utils.select_fields(dict(
             id=self.id,
-            user=self.user_info,
-            apartment=self.apartment_info,
-            room=self.room_info,
             date_start=self.date_start.isoformat(),
             date_end=self.date_end.isoformat(),
             created_at=self.created_at.isoformat(),
             deleted=self.deleted,
-        )
+        ), fields, expand, dict(
+            user=(self.username, lambda **kwargs:
+                user or self.user.serialize(**kwargs)),
+            apartment=(self.apartment_id, lambda **kwargs:
+                apartment or self.apartment.serialize(**kwargs)),
+            room=(self.room_id, lambda **kwargs:
+                room or self.room.serialize(**kwargs)),
+        ))
 
 
 class Reserve(db.Model):
@@ -1285,6 +1938,9 @@ class Reserve(db.Model):
             reserve_choice_id=reserve_choice_id,
         )
         db.session.add(reserve)
+        Apartment.query.filter_by(id=reserve_choice.apartment_id).update(
+            {Apartment.num_reserve: Apartment.num_reserve + 1},
+            synchronize_session=False)
         db.session.commit()
         return reserve
 
@@ -1336,30 +1992,71 @@ class Reserve(db.Model):
         raise utils.APIException(utils.API_CODE_NOT_AUTHORIZED,
             name=cls.__tablename__)
 
-    def serialize(self):
-        return dict(
+    @classmethod
+    def serialize_list(cls, reserves, fields=None, expand=None):
+        """ Serialize reserves with one IN query per expanded relationship.
+        """
+        if not reserves:
+            return []
+        user_infos = {}
+        if utils.is_expanded('user', fields, expand):
+            user_infos = User.serialize_dict(
+                list(set(reserve.username for reserve in reserves)),
+                **utils.sub_fields('user', fields, expand))
+        apartment_infos = {}
+        if utils.is_expanded('apartment', fields, expand):
+            apartment_infos = Apartment.serialize_dict(
+                list(set(reserve.apartment_id for reserve in reserves)),
+                **utils.sub_fields('apartment', fields, expand))
+        reserve_choice_infos = {}
+        if utils.is_expanded('reserve_choice', fields, expand):
+            reserve_choices = ReserveChoice.query.filter(ReserveChoice.id.in_(
+                list(set(reserve.reserve_choice_id
+                    for reserve in reserves)))).all()
+            reserve_choice_infos = dict((reserve_choice.id,
+                reserve_choice.serialize(
+                    **utils.sub_fields('reserve_choice', fields, expand)))
+                for reserve_choice in reserve_choices)
+        return [reserve.serialize(
+            user=user_infos.get(reserve.username),
+            apartment=apartment_infos.get(reserve.apartment_id),
+            reserve_choice=reserve_choice_infos.get(
+                reserve.reserve_choice_id),
+            fields=fields,
+            expand=expand,
+        ) for reserve in reserves]
+
+    def serialize(self, user=None, apartment=None, reserve_choice=None,
+        fields=None, expand=None):
+        return utils.select_fields(dict(
             id=self.id,
-            user=self.user_info,
-            apartment=self.apartment_info,
-            reserve_choice=self.reserve_choice_info,
             cancelled=self.cancelled,
             created_at=self.created_at.isoformat(),
             deleted=self.deleted,
-        )
+        ), fields, expand, dict(
+            user=(self.username, lambda **kwargs:
+                user or self.user.serialize(**kwargs)),
+            apartment=(self.apartment_id, lambda **kwargs:
+                apartment or self.apartment.serialize(**kwargs)),
+            reserve_choice=(self.reserve_choice_id, lambda **kwargs:
+                reserve_choice or self.reserve_choice.serialize(**kwargs)),
+        ))
 
 
 class Message(db.Model):
     __tablename__ = 'messages'
     __table_args__ = (
-        db.Index('ix_message_key_deleted', 'key', 'deleted'),
+        db.Index('ix_message_key_deleted_id', 'key', 'deleted', 'id'),
         db.Index('ix_message_key_to_username_unread', 'key', 'to_username',
             'unread'),
-        db.Index('ix_message_key_to_username_unread_deleted', 'key',
-            'to_username', 'unread', 'deleted'),
+        db.Index('ix_message_key_to_username_unread_deleted_id', 'key',
+            'to_username', 'unread', 'deleted', 'id'),
         db.Index('ix_message_from_username_to_username_unread_deleted',
             'from_username', 'to_username', 'unread', 'deleted'),
         db.Index('ix_message_to_username_unread_deleted', 'to_username',
             'unread', 'deleted'),
+        db.Index('ix_message_to_username_deleted_id', 'to_username',
+            'deleted', 'id'),
     )
 
     id = db.Column(db.Integer, primary_key=True)
@@ -1400,11 +2097,29 @@ class Message(db.Model):
                 app.config['UPLOAD_MESSAGE_FOLDER'])
 
     @classmethod
-    def mark_as_read(cls, messages, username):
-        for message in messages:
-            if message.to_username == username:
-                message.unread=False
+    def mark_as_read(cls, key, username, max_id=None, min_id=None):
+        """ Mark the unread messages to username in conversation key with ids
+        up to max_id, and from min_id, as read in one UPDATE, then take the
+        number of rows changed off the unread counters. """
+        res = cls.query.filter(
+            Message.key == key,
+            Message.to_username == username,
+            Message.unread == True,
+            Message.deleted == False,
+        )
+        if max_id is not None:
+            res = res.filter(Message.id <= max_id)
+        if min_id is not None:
+            res = res.filter(Message.id >= min_id)
+        num = res.update({Message.unread: False},
+            synchronize_session='evaluate')
+        if num:
+            Conversation.mark_as_read(key, username, num)
+            User.query.filter_by(username=username).update(
+                {User.num_unread_messages: User.num_unread_messages - num},
+                synchronize_session=False)
         db.session.flush()
+        return num
 
     @classmethod
     def get_key(cls, from_username, to_username):
@@ -1420,7 +2135,13 @@ class Message(db.Model):
         )
         message.content_info = content
         db.session.add(message)
+        db.session.flush()
+        Conversation.update(message)
+        User.query.filter_by(username=to_username).update(
+            {User.num_unread_messages: User.num_unread_messages + 1},
+            synchronize_session=False)
         db.session.commit()
+        notifier.publish(to_username, message.id)
         return message
 
     @classmethod
@@ -1433,9 +2154,27 @@ class Message(db.Model):
             raise utils.APIException(utils.API_CODE_MESSAGE_NOT_FOUND)
         return res
 
+    @classmethod
+    def get_page_size(cls, limit=None):
+        return min(limit or app.config['MESSAGE_PAGE_SIZE'],
+            app.config['MESSAGE_MAX_PAGE_SIZE'])
+
     @classmethod
     def gets(cls, to_username, from_username, filter_unread=True,
-        filter_deleted=True, **kwargs):
+        filter_deleted=True, before_id=None, after_id=None, limit=None,
+        mark_read=True, **kwargs):
+        """ A page of at most `limit` messages of a conversation, oldest
+        first.
+
+        With `after_id` the page holds the messages right after it, for
+        incremental sync, otherwise the latest ones before `before_id`, or
+        the latest ones at all, for scrolling back in history. Unread
+        messages without `before_id` are paged oldest first too, so they
+        are read in order. Unless
+        `mark_read` is False, the messages of the page sent to `to_username`
+        are marked as read.
+        """
+        limit = cls.get_page_size(limit)
         key=cls.get_key(to_username, from_username)
         res = cls.query.filter_by(key=key)
         if filter_unread:
@@ -1445,10 +2184,36 @@ class Message(db.Model):
             ))
         if filter_deleted:
             res = res.filter_by(deleted=False)
-        res = res.limit(100).all()
-        cls.mark_as_read(res, to_username)
+        if after_id or (filter_unread and not before_id):
+            if after_id:
+                res = res.filter(Message.id > after_id)
+            res = res.order_by(Message.id).limit(limit).all()
+        else:
+            if before_id:
+                res = res.filter(Message.id < before_id)
+            res = res.order_by(Message.id.desc()).limit(limit).all()
+            res.reverse()
+        if mark_read and res:
+            cls.mark_as_read(key, to_username, res[-1].id, res[0].id)
         return res
 
+    @classmethod
+    def gets_received(cls, to_username, after_id, limit=None):
+        """ Messages to a user after after_id in all conversations, oldest
+        first, for /api/message/stream. """
+        return cls.query.filter(
+            Message.to_username == to_username,
+            Message.deleted == False,
+            Message.id > after_id,
+        ).order_by(Message.id).limit(cls.get_page_size(limit)).all()
+
+    @classmethod
+    def get_last_received_id(cls, to_username):
+        return db.session.query(db.func.max(Message.id)).filter(
+            Message.to_username == to_username,
+            Message.deleted == False,
+        ).scalar() or 0
+
     def set(self, **kwargs):
         for key in kwargs:
             if kwargs[key] is not None:
@@ -1460,17 +2225,161 @@ class Message(db.Model):
             raise utils.APIException(utils.API_CODE_NOT_AUTHORIZED,
                 name=self.__tablename__)
 
-    def serialize(self):
-        return dict(
+    def serialize(self, fields=None, expand=None):
+        return utils.select_fields(dict(
             id=self.id,
             from_username=self.from_username,
             to_username=self.to_username,
-            content=self.content_info,
+            content=lambda: self.content_info,
             type=self.type,
             unread=self.unread,
             created_at=self.created_at.isoformat(),
             deleted=self.deleted,
-        )
+        ), fields)
+
+
+class Conversation(db.Model):
+    __tablename__ = 'conversations'
+    __table_args__ = (
+        db.Index('ix_conversation_first_username_last_message_id',
+            'first_username', 'last_message_id'),
+        db.Index('ix_conversation_second_username_last_message_id',
+            'second_username', 'last_message_id'),
+    )
+
+    key = db.Column(db.String(64), primary_key=True)
+    first_username = db.Column(db.String(128), db.ForeignKey('users.username'))
+    second_username = db.Column(db.String(128),
+        db.ForeignKey('users.username'))
+
+    last_message_id = db.Column(db.Integer, db.ForeignKey('messages.id'))
+    num_unread_first = db.Column(db.Integer, default=0)
+    num_unread_second = db.Column(db.Integer, default=0)
+
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+
+    @classmethod
+    def update(cls, message):
+        """ Record a newly created message in its conversation.
+
+        The first messages of a conversation may be sent concurrently, so the
+        row is inserted in a savepoint, and if another transaction inserted
+        it first, that row is locked and counted like an existing one.
+        """
+        conversation = cls.query.filter_by(key=message.key).first()
+        if not conversation:
+            first_username, second_username = sorted(
+                [message.from_username, message.to_username])
+            try:
+                with db.session.begin_nested():
+                    conversation = cls(
+                        key=message.key,
+                        first_username=first_username,
+                        second_username=second_username,
+                        num_unread_first=0,
+                        num_unread_second=0,
+                    )
+                    db.session.add(conversation)
+            except IntegrityError:
+                conversation = cls.query.filter_by(key=message.key
+                    ).with_for_update().one()
+        if message.to_username == conversation.first_username:
+            conversation.num_unread_first = cls.num_unread_first + 1
+        else:
+            conversation.num_unread_second = cls.num_unread_second + 1
+        conversation.last_message_id = message.id
+        conversation.updated_at = message.created_at or datetime.now()
+        db.session.flush()
+        return conversation
+
+    @classmethod
+    def mark_as_read(cls, key, username, num):
+        conversation = cls.query.filter_by(key=key).first()
+        if not conversation:
+            return
+        if username == conversation.first_username:
+            conversation.num_unread_first = cls.num_unread_first - num
+        else:
+            conversation.num_unread_second = cls.num_unread_second - num
+        db.session.flush()
+
+    @classmethod
+    def gets(cls, username):
+        return cls.query.filter(or_(
+            cls.first_username == username,
+            cls.second_username == username,
+        )).order_by(cls.last_message_id.desc()).all()
+
+    @classmethod
+    def rebuild(cls):
+        """ Recompute all conversations from the messages table. """
+        cls.query.delete()
+        last_message_ids = [message_id for _, message_id in
+            db.session.query(
+                Message.key,
+                db.func.max(Message.id),
+            ).group_by(Message.key).all()]
+        num_unread = dict(((key, to_username), num) for key, to_username, num in
+            db.session.query(
+                Message.key,
+                Message.to_username,
+                db.func.count(Message.id),
+            ).filter_by(unread=True, deleted=False
+            ).group_by(Message.key, Message.to_username).all())
+        if last_message_ids:
+            for message in Message.query.filter(
+                    Message.id.in_(last_message_ids)).all():
+                first_username, second_username = sorted(
+                    [message.from_username, message.to_username])
+                db.session.add(cls(
+                    key=message.key,
+                    first_username=first_username,
+                    second_username=second_username,
+                    last_message_id=message.id,
+                    num_unread_first=num_unread.get(
+                        (message.key, first_username), 0),
+                    num_unread_second=num_unread.get(
+                        (message.key, second_username), 0),
+                    updated_at=message.created_at,
+                ))
+        db.session.commit()
+
+    def get_peer_username(self, username):
+        if username == self.first_username:
+            return self.second_username
+        return self.first_username
+
+    def get_num_unread(self, username):
+        if username == self.first_username:
+            return self.num_unread_first
+        return self.num_unread_second
+
+    @classmethod
+    def serialize_list(cls, conversations, username):
+        """ Serialize conversations of a user with one IN query for peers and
+        one for last messages. """
+        if not conversations:
+            return []
+        users = User.query.filter(User.username.in_(list(set(
+            conversation.get_peer_username(username)
+            for conversation in conversations)))).filter_by(deleted=False).all()
+        user_infos = dict(zip(
+            [user.username for user in users],
+            User.serialize_list(users),
+        ))
+        messages = Message.query.filter(Message.id.in_([
+            conversation.last_message_id
+            for conversation in conversations])).all()
+        message_infos = dict((message.id, message.serialize())
+            for message in messages)
+        return [{
+            'user': user_infos[conversation.get_peer_username(username)],
+            'message': message_infos[conversation.last_message_id],
+            'num_unread': conversation.get_num_unread(username),
+        } for conversation in conversations
+            if conversation.get_peer_username(username) in user_infos and
+                conversation.last_message_id in message_infos]
 
 
 class Comment(db.Model):
@@ -1534,16 +2443,37 @@ class Comment(db.Model):
                 setattr(self, key, kwargs[key])
         db.session.flush()
 
-    def serialize(self):
-        return dict(
+    @classmethod
+    def serialize_list(cls, comments, fields=None, expand=None):
+        """ Serialize comments with one IN query for their users. """
+        usernames = list(set(comment.username for comment in comments))
+        if not usernames:
+            return []
+        user_infos = {}
+        if utils.is_expanded('user', fields, expand):
+            user_infos = User.serialize_dict(usernames,
+                **utils.sub_fields('user', fields, expand))
+        return [comment.serialize(
+            user=user_infos.get(comment.username),
+            fields=fields,
+            expand=expand,
+        ) for comment in comments]
+
+    def serialize(self, user=None, fields=None, expand=None):
+        if user is None:
+            embed = lambda **kwargs: self.user.serialize(**kwargs)
+        else:
+            embed = lambda **kwargs: user
+        return utils.select_fields(dict(
             id=self.id,
-            user=self.user_info,
             #apartment=self.apartment_info,
             content=self.content,
             rate=self.rate,
             created_at=self.created_at.isoformat(),
             deleted=self.deleted,
-        )
+        ), fields, expand, dict(
+            user=(self.username, embed),
+        ))
 
 
 class Captcha(db.Model):
@@ -1661,7 +2591,12 @@ class Token(db.Model):
     @classmethod
     def getter(cls, access_token=None, refresh_token=None):
         if access_token:
-            return cls.query.filter_by(access_token=access_token).first()
+            token = token_cache.get(access_token)
+            if token is None:
+                token = cls.query.filter_by(access_token=access_token).first()
+                if token:
+                    token_cache.set(access_token, CachedToken(token))
+            return token
         elif refresh_token:
             return cls.query.filter_by(refresh_token=refresh_token).first()
 
@@ -1673,6 +2608,7 @@ class Token(db.Model):
         )
 
         for t in tokens:
+            token_cache.delete(t.access_token)
             db.session.delete(t)
 
         expires_in = token.pop('expires_in')
@@ -1691,6 +2627,36 @@ class Token(db.Model):
         db.session.commit()
         return token
 
+    @classmethod
+    def invalidate(cls, username):
+        """ Drop cached tokens of a user whose profile has changed. """
+        for access_token, in db.session.query(cls.access_token).filter_by(
+                username=username).all():
+            token_cache.delete(access_token)
+
+
+class CachedToken(object):
+    """ A Token with its user and client kept as column snapshots, so that a
+    cache hit authenticates a request without any query.
+    """
+
+    def __init__(self, token):
+        self.access_token = token.access_token
+        self.expires = token.expires
+        self.scopes = token.scopes
+        self.username = token.username
+        self.client_id = token.client_id
+        self.user_values = snapshot(token.user)
+        self.client_values = snapshot(token.client)
+
+    @property
+    def user(self):
+        return restore(User, self.user_values)
+
+    @property
+    def client(self):
+        return restore(Client, self.client_values)
+
 
 class Admin(db.Model):
     __tablename__ = 'admins'
@@ -1707,7 +2673,7 @@ class Admin(db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hashing.generate(password)
 
     def is_authenticated(self):
         return True
@@ -1743,12 +2709,62 @@ class Admin(db.Model):
         return res
 
     def verify_password(self, password):
-        if check_password_hash(self.password_hash, password):
+        if hashing.check(self.password_hash, password):
+            if hashing.needs_rehash(self.password_hash):
+                self.password = password
+                db.session.commit()
             return True
         else:
             raise utils.APIException(utils.API_CODE_PASSWORD_INVALID)
 
 
-whooshalchemy.whoosh_index(app, School)
-whooshalchemy.whoosh_index(app, Community)
-whooshalchemy.whoosh_index(app, Apartment)
+class DataVersion(db.Model):
+    """ Version counters of reference data, bumped in the transaction of
+    every flush that writes it, to key cached responses. """
+    __tablename__ = 'data_versions'
+
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def get(cls, name):
+        return db.session.query(cls.version).filter_by(name=name).scalar() \
+            or 0
+
+    @classmethod
+    def bump(cls, session, name):
+        table = cls.__table__
+        res = session.execute(table.update().where(table.c.name == name
+            ).values(version=table.c.version + 1))
+        if not res.rowcount:
+            session.execute(table.insert().values(name=name, version=1))
+
+
+# Schools and communities, with their relationship and apartment counts, as
+# served by /api/school/list and /api/community/list.
+REFERENCE_DATA = 'reference'
+
+
+def is_reference_data_changed(session):
+    for instance in session.new | session.deleted:
+        if isinstance(instance, (School, Community, Apartment)):
+            return True
+    for instance in session.dirty:
+        if isinstance(instance, (School, Community)):
+            if session.is_modified(instance):
+                return True
+        elif isinstance(instance, Apartment):
+            if inspect(instance).attrs.community_id.history.has_changes():
+                return True
+    return False
+
+
+@event.listens_for(db.session, 'after_flush')
+def bump_reference_data(session, flush_context):
+    if is_reference_data_changed(session):
+        DataVersion.bump(session, REFERENCE_DATA)
+
+
+search.register(School)
+search.register(Community)
+search.register(Apartment)
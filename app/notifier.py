@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: notifier.py
+Author: huxuan
+Email: i(at)huxuan.org
+Description: Wake up the message streams of a user when a message arrives.
+
+The `local` backend only reaches streams in the same process, the `redis`
+backend relays through a Redis protocol server (cache_server.py is a local
+stand-in) to every worker and host.
+"""
+from threading import Lock
+from threading import Thread
+import logging
+import os
+import Queue
+import time
+
+from app import app
+
+logger = logging.getLogger(__name__)
+
+
+class LocalNotifier(object):
+    """ A queue per open stream, keyed by the username it belongs to. """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.subscribers = {}
+
+    def subscribe(self, username):
+        queue = Queue.Queue()
+        with self.lock:
+            self.subscribers.setdefault(username, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, username, queue):
+        with self.lock:
+            queues = self.subscribers.get(username, set())
+            queues.discard(queue)
+            if not queues:
+                self.subscribers.pop(username, None)
+
+    def publish(self, username, message_id):
+        self.dispatch(username, message_id)
+
+    def dispatch(self, username, message_id):
+        with self.lock:
+            queues = list(self.subscribers.get(username, ()))
+        for queue in queues:
+            queue.put(message_id)
+
+
+class RedisNotifier(LocalNotifier):
+    """ Publish on a Redis channel, one listener thread per process relays
+    the notifications to its local queues. """
+
+    def __init__(self):
+        super(RedisNotifier, self).__init__()
+        import redis
+        self.redis = redis
+        self.client = redis.StrictRedis.from_url(
+            app.config['NOTIFIER_REDIS_URL'])
+        self.channel = '{}messages'.format(app.config['CACHE_KEY_PREFIX'])
+        self.pid = None
+        self.pid_lock = Lock()
+
+    def start(self):
+        with self.pid_lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            listener = Thread(target=self.listen)
+            listener.daemon = True
+            listener.start()
+
+    def subscribe(self, username):
+        self.start()
+        return super(RedisNotifier, self).subscribe(username)
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for item in pubsub.listen():
+                    if item['type'] != 'message':
+                        continue
+                    username, message_id = item['data'].rsplit(' ', 1)
+                    self.dispatch(username, int(message_id))
+            except self.redis.RedisError:
+                logger.exception('notifier connection lost')
+                time.sleep(1)
+
+    def publish(self, username, message_id):
+        try:
+            self.client.publish(self.channel,
+                '{} {}'.format(username, message_id))
+        except self.redis.RedisError:
+            logger.exception('notifier publish failed')
+
+
+BACKENDS = dict(
+    local=LocalNotifier,
+    redis=RedisNotifier,
+)
+
+backend = BACKENDS[app.config['NOTIFIER_BACKEND']]()
+
+
+def subscribe(username):
+    return backend.subscribe(username)
+
+
+def unsubscribe(username, queue):
+    backend.unsubscribe(username, queue)
+
+
+def publish(username, message_id):
+    backend.publish(username, message_id)
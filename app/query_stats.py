@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: query_stats.py
+Author: huxuan
+Email: i(at)huxuan.org
+Description: Per request query count and SQL time instrumentation.
+"""
+from time import time
+import logging
+
+from flask import g
+from flask import has_request_context
+from flask import json
+from flask import request
+from sqlalchemy import event
+
+from app import app
+from app import db
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.statements = {}
+
+    def record(self, statement, parameters, elapsed):
+        self.count += 1
+        self.time += elapsed
+        self.statements[statement] = self.statements.get(statement, 0) + 1
+
+    @property
+    def duplicates(self):
+        """ Statements run more than once, whatever their parameters, which
+        is how an N+1 query shows up. """
+        return sorted([(statement, count)
+            for statement, count in self.statements.items()
+            if count > 1], key=lambda x: x[1], reverse=True)
+
+    @property
+    def num_duplicates(self):
+        return sum([count - 1 for _, count in self.duplicates])
+
+    def to_dict(self):
+        return dict(
+            query_count=self.count,
+            query_time_ms=round(self.time * 1000, 3),
+            query_duplicates=self.num_duplicates,
+            duplicate_statements=[dict(statement=statement, count=count)
+                for statement, count in
+                self.duplicates[:app.config['QUERY_STATS_MAX_DUPLICATES']]],
+        )
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+    executemany):
+    conn.info.setdefault('query_start_time', []).append(time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+    executemany):
+    elapsed = time() - conn.info['query_start_time'].pop()
+    if has_request_context():
+        query_stats = getattr(g, 'query_stats', None)
+        if query_stats is not None:
+            query_stats.record(statement, parameters, elapsed)
+
+
+def handle_error(context):
+    """ Drop the start time of a statement which failed, no
+    after_cursor_execute follows it. """
+    if context.connection is not None and context.cursor is not None:
+        start_times = context.connection.info.get('query_start_time')
+        if start_times:
+            start_times.pop()
+
+
+def start_query_stats():
+    g.query_stats = QueryStats()
+
+
+def report_query_stats(response):
+    query_stats = getattr(g, 'query_stats', None)
+    if query_stats is None:
+        return response
+    if app.debug:
+        response.headers['X-Query-Count'] = str(query_stats.count)
+        response.headers['X-Query-Time'] = '{:.3f}'.format(
+            query_stats.time * 1000)
+        response.headers['X-Query-Duplicates'] = str(
+            query_stats.num_duplicates)
+    else:
+        res = dict(
+            method=request.method,
+            path=request.path,
+            endpoint=request.endpoint,
+            status=response.status_code,
+        )
+        res.update(query_stats.to_dict())
+        logger.info(json.dumps(res))
+    return response
+
+
+if app.config.get('QUERY_STATS'):
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(db.engine, 'handle_error', handle_error)
+    app.before_request(start_query_stats)
+    app.after_request(report_query_stats)
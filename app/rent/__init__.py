@@ -157,21 +157,27 @@ class ListAPI(Resource):
 
         :<header Authorization: OAuth access_token
         :query int apartment_id: 房屋 ID
+        :query string fields: 返回的字段，以逗号分隔，嵌套字段用 ``.`` 连接
+        :query string expand: 展开的关联对象，以逗号分隔，默认全部展开
         :>json string message: 可能的错误信息
         :>json int status_code: 状态代码
         :>json array rents: 租房记录列表的 serialize 信息
         """
         parser = self.parser.copy()
         parser.add_argument('apartment_id', type=int)
+        parser.add_argument('fields', type=utils.tree_type)
+        parser.add_argument('expand', type=utils.tree_type)
         args = parser.parse_args(request)
+        fields = args.pop('fields')
+        expand = args.pop('expand')
         if args.get('apartment_id'):
             apartment = models.Apartment.get(args['apartment_id'])
             apartment.verify_owner(request.oauth.user.username)
         else:
             args['username'] = request.oauth.user.username
         payload = dict(
-            rents=[rent.serialize()
-                for rent in models.Rent.gets(**args)],
+            rents=models.Rent.serialize_list(models.Rent.gets(**args),
+                fields=fields, expand=expand),
         )
         return utils.api_response(payload=payload)
 
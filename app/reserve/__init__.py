@@ -193,6 +193,8 @@ class ListAPI(Resource):
 只有房东和已预约的房客才有权限
         :query int reserve_choice_id: 预约记录 ID，用于筛选同一预约选项的预约，\
 只有房东和已预约的房客才有权限
+        :query string fields: 返回的字段，以逗号分隔，嵌套字段用 ``.`` 连接
+        :query string expand: 展开的关联对象，以逗号分隔，默认全部展开
         :>json string message: 可能的错误信息
         :>json int status_code: 状态代码
         :>json array reserves: 预约记录列表的 serialize 信息
@@ -201,11 +203,16 @@ class ListAPI(Resource):
         parser.add_argument('username')
         parser.add_argument('apartment_id', type=int)
         parser.add_argument('reserve_choice_id', type=int)
+        parser.add_argument('fields', type=utils.tree_type)
+        parser.add_argument('expand', type=utils.tree_type)
         args = parser.parse_args(request)
+        fields = args.pop('fields')
+        expand = args.pop('expand')
         reserves = models.Reserve.gets(**args)
         models.Reserve.is_accessible(reserves, request.oauth.user.username)
         payload = dict(
-            reserves=[reserve.serialize() for reserve in reserves],
+            reserves=models.Reserve.serialize_list(reserves, fields=fields,
+                expand=expand),
         )
         return utils.api_response(payload=payload)
 
@@ -144,17 +144,24 @@ class ListAPI(Resource):
             }
 
         :param int apartment_id: 房屋 ID，用于筛选某一房屋的所有预约选项
+        :param string fields: 返回的字段，以逗号分隔，嵌套字段用 ``.`` 连接
+        :param string expand: 展开的关联对象，以逗号分隔，默认全部展开
         :>json string message: 可能的错误信息
         :>json int status_code: 状态代码
         :>json array reserve_choices: 预约选项列表的 serialize 信息
         """
         parser = self.parser.copy()
         parser.add_argument('apartment_id', type=int, required=True)
+        parser.add_argument('fields', type=utils.tree_type)
+        parser.add_argument('expand', type=utils.tree_type)
         args = parser.parse_args(request)
+        fields = args.pop('fields')
+        expand = args.pop('expand')
         apartment = models.Apartment.get(args['apartment_id'])
         payload = dict(
-            reserve_choices=[reserve_choice.serialize()
-                for reserve_choice in models.ReserveChoice.gets(**args)],
+            reserve_choices=[reserve_choice.serialize(fields=fields,
+                expand=expand) for reserve_choice in
+                models.ReserveChoice.gets(**args)],
         )
         return utils.api_response(payload=payload)
 
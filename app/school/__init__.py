@@ -92,15 +92,29 @@ class ListAPI(Resource):
                 ]
             }
 
+        :query string fields: 返回的字段，以逗号分隔，嵌套字段用 ``.`` 连接
+        :query string expand: 展开的关联对象，以逗号分隔，默认全部展开
+        :<header If-None-Match: 上次返回的 ETag，数据未变化时返回 304
+        :>header ETag: 数据版本对应的 ETag
         :>json string message: 可能的错误信息
         :>json int status_code: 状态代码
         :>json array schools: 学校列表的 serialize 信息
         """
-        payload = dict(
-            schools=[school.serialize()
-                for school in models.School.gets()],
-        )
-        return utils.api_response(payload=payload)
+        parser = reqparse.RequestParser()
+        parser.add_argument('fields', type=utils.tree_type)
+        parser.add_argument('expand', type=utils.tree_type)
+        args = parser.parse_args(request)
+
+        def build():
+            payload = dict(
+                schools=models.School.serialize_list(
+                    models.School.gets(), **args),
+            )
+            return utils.api_response(payload=payload)
+
+        version = models.DataVersion.get(models.REFERENCE_DATA)
+        return utils.cached_response(
+            ('school_list', version, request.query_string), build)
 
 
 class SearchAPI(Resource):
@@ -132,16 +146,22 @@ class SearchAPI(Resource):
             }
 
         :param string q: **Required** 检索关键词
+        :query string fields: 返回的字段，以逗号分隔，嵌套字段用 ``.`` 连接
+        :query string expand: 展开的关联对象，以逗号分隔，默认全部展开
         :>json string message: 可能的错误信息
         :>json int status_code: 状态代码
         :>json array schools: 学校列表的 serialize 信息
         """
         parser = reqparse.RequestParser()
         parser.add_argument('q', required=True)
+        parser.add_argument('fields', type=utils.tree_type)
+        parser.add_argument('expand', type=utils.tree_type)
         args = parser.parse_args(request)
+        fields = args.pop('fields')
+        expand = args.pop('expand')
         payload = dict(
-            schools=[school.serialize()
-                for school in models.School.search(**args)],
+            schools=models.School.serialize_list(
+                models.School.search(**args), fields=fields, expand=expand),
         )
         return utils.api_response(payload=payload)
 
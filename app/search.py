@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: search.py
+Author: huxuan
+Email: i(at)huxuan.org
+Description: Full text search inside the database.
+
+Every searchable model gets a table `search_<tablename>` which maps the id of
+a row to the jieba tokenized text of its `__searchable__` columns, so the
+query is answered by the database itself and shared by all worker processes.
+Committed changes reach the search tables in batches from a background
+indexer, at most `SEARCH_INDEX_MAX_DELAY_SECONDS` later.
+"""
+from threading import Event
+from threading import Lock
+from threading import Thread
+import atexit
+import logging
+import os
+import re
+
+from flask.ext.sqlalchemy import models_committed
+from sqlalchemy import column
+from sqlalchemy import false
+from sqlalchemy import literal_column
+from sqlalchemy import table
+from sqlalchemy import text
+import jieba
+
+from app import app
+from app import db
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r'\w', re.UNICODE)
+
+
+def tokenize(value):
+    """ Split text into lower case jieba tokens for search. """
+    if not value:
+        return []
+    return [token.lower() for token in jieba.cut_for_search(value)
+        if TOKEN_PATTERN.search(token)]
+
+
+class SearchBackend(object):
+    """ Interface of search backends.
+
+    Subclasses provide the DDL of the search tables, the match clause and
+    the relevance of a query, the rest is shared.
+    """
+    id_column = 'id'
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def table(self, model):
+        return table('search_{}'.format(model.__tablename__),
+            column(self.id_column), column('body'))
+
+    def create(self, model):
+        raise NotImplementedError
+
+    def drop(self, model):
+        self.engine.execute(text('DROP TABLE IF EXISTS {}'.format(
+            self.table(model).name)))
+
+    def format_query(self, tokens):
+        raise NotImplementedError
+
+    def score(self, search_table, match):
+        raise NotImplementedError
+
+    def document(self, model, row):
+        return u' '.join(token for key in model.__searchable__
+            for token in tokenize(getattr(row, key)))
+
+    def documents(self, model, rows):
+        return [{
+            self.id_column: row.id,
+            'body': self.document(model, row),
+        } for row in rows]
+
+    def insert(self, model, rows, conn=None):
+        """ Add documents of rows known to be missing. """
+        if not rows:
+            return
+        (conn or self.engine).execute(self.table(model).insert(),
+            self.documents(model, rows))
+
+    def update(self, model, rows):
+        """ Replace the documents of rows. """
+        if not rows:
+            return
+        search_table = self.table(model)
+        id_column = search_table.c[self.id_column]
+        with self.engine.begin() as conn:
+            conn.execute(search_table.delete().where(
+                id_column.in_([row.id for row in rows])))
+            conn.execute(search_table.insert(), self.documents(model, rows))
+
+    def clear(self, model, conn=None):
+        (conn or self.engine).execute(self.table(model).delete())
+
+    def delete(self, model, ids):
+        if not ids:
+            return
+        search_table = self.table(model)
+        with self.engine.begin() as conn:
+            conn.execute(search_table.delete().where(
+                search_table.c[self.id_column].in_(ids)))
+
+    def search(self, query, model, q):
+        """ Filter query of model by q, most relevant first. """
+        tokens = tokenize(q)
+        if not tokens:
+            return query.filter(false())
+        search_table = self.table(model)
+        match = search_table.c.body.match(self.format_query(tokens))
+        return query.join(search_table,
+            model.id == search_table.c[self.id_column],
+            ).filter(match).order_by(self.score(search_table, match))
+
+
+class MySQLBackend(SearchBackend):
+    """ InnoDB FULLTEXT index over the pre tokenized text.
+
+    Tokens are separated by spaces, so the built in parser works for Chinese,
+    but `innodb_ft_min_token_size` has to be lowered to 1 in my.cnf.
+    """
+
+    def create(self, model):
+        self.engine.execute(text("""
+            CREATE TABLE IF NOT EXISTS {} (
+                id INTEGER NOT NULL PRIMARY KEY,
+                body TEXT NOT NULL,
+                FULLTEXT INDEX ft_body (body)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+        """.format(self.table(model).name)))
+
+    def format_query(self, tokens):
+        return u' '.join(u'+"{}"'.format(token.replace('"', ''))
+            for token in tokens)
+
+    def score(self, search_table, match):
+        return match.desc()
+
+
+class SQLiteBackend(SearchBackend):
+    """ FTS5 virtual table keyed by rowid. """
+    id_column = 'rowid'
+
+    def create(self, model):
+        self.engine.execute(text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(body)'.format(
+                self.table(model).name)))
+
+    def format_query(self, tokens):
+        return u' '.join(u'"{}"'.format(token.replace('"', '""'))
+            for token in tokens)
+
+    def score(self, search_table, match):
+        return literal_column('{}.rank'.format(search_table.name))
+
+
+BACKENDS = dict(
+    mysql=MySQLBackend,
+    sqlite=SQLiteBackend,
+)
+
+
+class Indexer(object):
+    """ Collect the ids of committed searchable rows and apply them to the
+    search tables in batches from a background thread.
+
+    A batch is applied when `batch_size` ids are pending or `max_delay`
+    seconds after the previous one, whichever comes first. The thread is
+    started lazily in the process that first commits, like the SMS workers.
+    """
+
+    def __init__(self, max_delay, batch_size):
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.pending = {}
+        self.lock = Lock()
+        self.event = Event()
+        self.pid = None
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.pending = {}
+            worker = Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def add(self, model, ids):
+        self.start()
+        with self.lock:
+            self.pending.setdefault(model.__name__, set()).update(ids)
+            num_pending = sum(len(ids) for ids in self.pending.values())
+        if num_pending >= self.batch_size:
+            self.event.set()
+
+    def work(self):
+        while True:
+            self.event.wait(self.max_delay)
+            self.event.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('search index update failed')
+
+    def flush(self):
+        """ Apply the pending ids, they are queued again if that fails and
+        retried with the next batch. """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        with app.app_context():
+            try:
+                for name, ids in pending.items():
+                    ids = list(ids)
+                    for i in range(0, len(ids), self.batch_size):
+                        refresh(searchables[name], ids[i:i + self.batch_size])
+            except Exception:
+                with self.lock:
+                    for name, ids in pending.items():
+                        self.pending.setdefault(name, set()).update(ids)
+                raise
+            finally:
+                db.session.remove()
+
+
+backend = BACKENDS[app.config['SEARCH_BACKEND']](db.engine)
+indexer = Indexer(
+    max_delay=app.config['SEARCH_INDEX_MAX_DELAY_SECONDS'],
+    batch_size=app.config['SEARCH_INDEX_BATCH_SIZE'],
+)
+searchables = {}
+
+
+def register(model):
+    searchables[model.__name__] = model
+
+
+def search(query, model, q):
+    return backend.search(query, model, q)
+
+
+def create_all():
+    for model in searchables.values():
+        backend.create(model)
+
+
+def drop_all():
+    for model in searchables.values():
+        backend.drop(model)
+
+
+def query_rows(model):
+    """ Query only the id and the searchable columns of model. """
+    return db.session.query(model.id,
+        *[getattr(model, key) for key in model.__searchable__])
+
+
+def refresh(model, ids):
+    """ Bring the documents of ids in line with the database. """
+    rows = query_rows(model).filter(model.id.in_(ids)).all()
+    backend.update(model, rows)
+    backend.delete(model, list(set(ids) - set(row.id for row in rows)))
+
+
+def reindex(model, batch_size=None):
+    """ Rebuild the documents of model from the database in bulk.
+
+    The rebuild is one transaction, so searches keep seeing the old
+    documents until it commits.
+    """
+    batch_size = batch_size or app.config['SEARCH_REINDEX_BATCH_SIZE']
+    with backend.engine.begin() as conn:
+        backend.clear(model, conn)
+        last_id = 0
+        while True:
+            rows = query_rows(model).filter(model.id > last_id).order_by(
+                model.id).limit(batch_size).all()
+            if not rows:
+                break
+            backend.insert(model, rows, conn)
+            last_id = rows[-1].id
+            logger.info('reindexed {} up to id {}'.format(model.__name__,
+                last_id))
+
+
+def on_models_committed(sender, changes):
+    ids = {}
+    for instance, operation in changes:
+        model = searchables.get(type(instance).__name__)
+        if model is not None:
+            ids.setdefault(model, []).append(instance.id)
+    for model, model_ids in ids.items():
+        indexer.add(model, model_ids)
+
+
+models_committed.connect(on_models_committed, sender=app)
+atexit.register(indexer.flush)
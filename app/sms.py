@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: sms.py
+Author: huxuan
+Email: i(at)huxuan.org
+Description: Bounded worker pool to deliver SMS through the EMY gateway.
+"""
+from threading import Lock
+from threading import Thread
+from xml.etree import ElementTree
+import logging
+import os
+import Queue
+import time
+
+from flask import json
+from requests.adapters import HTTPAdapter
+import requests
+
+from app import app
+
+logger = logging.getLogger(__name__)
+
+
+class SMSGatewayError(Exception):
+    """ The gateway answered, but did not accept the SMS. """
+
+
+def check_response(content):
+    """ Raise SMSGatewayError unless the XML response of the EMY gateway
+    reports error code 0. It answers HTTP 200 for failures too. """
+    try:
+        root = ElementTree.fromstring(content)
+        error = int(root.findtext('error').strip())
+    except (ElementTree.ParseError, AttributeError, ValueError):
+        raise SMSGatewayError('malformed response: {!r}'.format(
+            content[:200]))
+    if error != 0:
+        raise SMSGatewayError('error {}: {}'.format(error,
+            (root.findtext('message') or '').strip().encode('utf-8')))
+
+
+class SMSDispatcher(object):
+    """ A fixed number of workers consume a bounded queue of SMS and post
+    them with one shared, pooled `requests.Session`.
+
+    Workers are started lazily in the process that first sends, so the pool
+    survives the fork of uWSGI workers.
+    """
+
+    def __init__(self, num_workers, max_queue_size, max_retries, backoff,
+        timeout):
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.queue = Queue.Queue(max_queue_size)
+        self.lock = Lock()
+        self.pid = None
+        self.session = None
+        self.counters = dict(sent=0, failed=0, retried=0, dropped=0)
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1,
+                pool_maxsize=self.num_workers)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            for _ in range(self.num_workers):
+                worker = Thread(target=self.work)
+                worker.daemon = True
+                worker.start()
+
+    def send(self, url, payload):
+        """ Queue an SMS, return False if the queue is full. """
+        self.start()
+        try:
+            self.queue.put_nowait((url, payload))
+        except Queue.Full:
+            self.incr('dropped')
+            logger.warning(json.dumps(dict(event='sms_dropped',
+                **self.stats())))
+            return False
+        return True
+
+    def work(self):
+        while True:
+            url, payload = self.queue.get()
+            try:
+                if self.deliver(url, payload):
+                    self.incr('sent')
+                else:
+                    self.incr('failed')
+                logger.info(json.dumps(dict(event='sms_delivered',
+                    **self.stats())))
+            finally:
+                self.queue.task_done()
+
+    def deliver(self, url, payload):
+        for retry in range(self.max_retries + 1):
+            if retry:
+                self.incr('retried')
+                time.sleep(self.backoff * 2 ** (retry - 1))
+            try:
+                res = self.session.post(url, data=payload,
+                    timeout=self.timeout)
+                res.raise_for_status()
+                check_response(res.content)
+                return True
+            except (requests.RequestException, SMSGatewayError), e:
+                logger.warning(json.dumps(dict(event='sms_error',
+                    retry=retry, error=str(e))))
+        return False
+
+    def incr(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        res = dict(
+            queue_depth=self.queue.qsize(),
+            max_queue_size=self.queue.maxsize,
+            num_workers=self.num_workers,
+        )
+        res.update(self.counters)
+        return res
+
+
+dispatcher = SMSDispatcher(
+    num_workers=app.config['SMS_NUM_WORKERS'],
+    max_queue_size=app.config['SMS_MAX_QUEUE_SIZE'],
+    max_retries=app.config['SMS_MAX_RETRIES'],
+    backoff=app.config['SMS_RETRY_BACKOFF_SECONDS'],
+    timeout=app.config['SMS_TIMEOUT_SECONDS'],
+)
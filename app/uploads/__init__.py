@@ -9,6 +9,7 @@ Description: Uploads related API.
 import os.path
 
 from flask import Blueprint
+from flask import make_response
 from flask import request
 from flask import safe_join
 from flask import send_file
@@ -25,13 +26,41 @@ uploads = Blueprint('uploads', __name__)
 api = Api(uploads)
 
 
+def accel_redirect(file_path):
+    """ Let nginx serve the file from its internal uploads location. """
+    response = make_response('')
+    response.mimetype = 'application/octet-stream'
+    response.headers['X-Accel-Redirect'] = '/'.join([
+        app.config['UPLOAD_ACCEL_REDIRECT_URL'].rstrip('/'),
+        file_path,
+    ])
+    return response
+
+
+def add_cache_headers(response, file_md5):
+    """ Files are stored by md5, so the content behind a path never changes.
+    """
+    response.set_etag(file_md5)
+    response.headers['Cache-Control'] = \
+        'public, max-age={}, immutable'.format(app.config['UPLOAD_MAX_AGE'])
+    return response
+
+
 class UploadsAPI(Resource):
     def get(self, file_path):
-        file_path = safe_join(app.config['UPLOAD_FOLDER'], file_path)
-        if os.path.isfile(file_path):
-            return send_file(file_path)
-        else:
+        file_md5 = utils.get_md5_from_url(file_path)
+        if file_md5 and request.if_none_match.contains(file_md5):
+            return add_cache_headers(make_response('', 304), file_md5)
+        full_path = safe_join(app.config['UPLOAD_FOLDER'], file_path)
+        if not os.path.isfile(full_path):
             raise utils.APIException(utils.API_CODE_NOT_FOUND, name='file')
+        if app.config['UPLOAD_ACCEL_REDIRECT']:
+            response = accel_redirect(file_path)
+        else:
+            response = send_file(full_path, add_etags=not file_md5)
+        if file_md5:
+            add_cache_headers(response, file_md5)
+        return response
 
 
 api.add_resource(UploadsAPI, '/<path:file_path>')
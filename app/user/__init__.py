@@ -64,6 +64,8 @@ class ListAPI(Resource):
     def __init__(self):
         self.parser = reqparse.RequestParser()
         self.parser.add_argument('username', action='append', default=[])
+        self.parser.add_argument('fields', type=utils.tree_type)
+        self.parser.add_argument('expand', type=utils.tree_type)
 
     def get(self):
         """ 获取用户列表
@@ -93,19 +95,23 @@ class ListAPI(Resource):
             }
 
         :param string username: 用户名（列表）
+        :param string fields: 返回的字段，以逗号分隔，嵌套字段用 ``.`` 连接
+        :param string expand: 展开的关联对象，以逗号分隔，默认全部展开
         :>json string message: 可能的错误信息
         :>json int status_code: 状态代码
-        :>json array users: 用户列表的 serialize 信息
+        :>json array users: 用户列表的 serialize 信息，与请求的用户名顺序一致
+        :>json array missing_usernames: 不存在的用户名列表
         """
         args = self.parser.parse_args(request)
+        missing_usernames = []
         if args['username']:
-            users = [models.User.get(username).serialize()
-                for username in args['username']]
+            users, missing_usernames = models.User.get_many(args['username'])
         else:
-            users = [user.serialize()
-                for user in models.User.gets()]
+            users = models.User.gets()
         payload = dict(
-            users=users,
+            users=models.User.serialize_list(users,
+                fields=args['fields'], expand=args['expand']),
+            missing_usernames=missing_usernames,
         )
         return utils.api_response(payload=payload)
 
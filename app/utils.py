@@ -7,19 +7,23 @@ Email: i(at)huxuan.org
 Description: Shared library for FangMi.
 """
 from datetime import datetime
-from shutil import copyfileobj
-from threading import Thread
-import cStringIO as StringIO
+import base64
+import errno
 import hashlib
+import math
 import os
 import re
 import requests
+import tempfile
 
 from flask import json
 from flask import jsonify
+from flask import request
 from flask.ext.restful import reqparse
 
 from app import app
+from app import cache
+from app import sms
 
 API_CODE_OK = 200
 
@@ -36,6 +40,7 @@ API_CODE_APARTMENT_NOT_AUTHORIZED = 1002
 API_CODE_CAPTCHA_INVALID = 2001
 API_CODE_CAPTCHA_NOT_FOUND = 2002
 API_CODE_CAPTCHA_EXCEED_FREQUENCY = 2003
+API_CODE_CAPTCHA_SMS_BUSY = 2004
 API_CODE_COMMUNITY_NOT_FOUND = 3001
 API_CODE_MESSAGE_NOT_FOUND = 4001
 API_CODE_PASSWORD_CONFIRM_INVALID = 5001
@@ -50,21 +55,29 @@ API_CODE_USER_NOT_FOUND = 9003
 ARGUMENT_NAME = {
     'apartments': '房屋',
     'captchas': '验证码',
+    'cursor': '分页游标',
     'devices': '设备',
     'devices.count': '设备数量',
     'devices.name': '设备名称',
+    'expand': '展开字段',
+    'fields': '返回字段',
     'file': '文件',
     'id_number': '身份证号',
     'json': 'Json 数据',
+    'limit': '每页数目',
     'major': '专业',
     'messages': '消息',
     'mobile': '手机号',
+    'near': '位置',
     'password': '密码',
     'password_confirm': '密码确认',
     'password_new': '新密码',
     'password_new_confirm': '密码确认',
     'password_old': '原始密码',
+    'price_max': '最高价格',
+    'price_min': '最低价格',
     'pic_student': '学生证图片',
+    'radius': '半径',
     'real_name': '姓名',
     'rents': '租房记录',
     'reserve_choices': '预约时间',
@@ -78,6 +91,7 @@ ARGUMENT_NAME = {
     'rooms.name': '房间名称',
     'rooms.price': '房间价格',
     'schools': '学校',
+    'sort': '排序方式',
     'student_id': '学号',
     'tags': '标签',
     'tags.name': '标签名称',
@@ -99,6 +113,7 @@ API_CODE_MESSAGE = {
     API_CODE_CAPTCHA_INVALID: u'验证码错误，请确认验证码输入正确。',
     API_CODE_CAPTCHA_NOT_FOUND: u'该手机号无对应验证码，请重新获取。',
     API_CODE_CAPTCHA_EXCEED_FREQUENCY: u'验证码请求频率超过限制，请稍后再试。',
+    API_CODE_CAPTCHA_SMS_BUSY: u'短信发送繁忙，请稍后再试。',
     API_CODE_COMMUNITY_NOT_FOUND: u'小区不存在。',
     API_CODE_MESSAGE_NOT_FOUND: '消息不存在。',
     API_CODE_PASSWORD_CONFIRM_INVALID: u'确认密码不一致。',
@@ -112,13 +127,6 @@ API_CODE_MESSAGE = {
 }
 
 
-def async(f):
-    def wrapper(*args, **kwargs):
-        thr = Thread(target=f, args=args, kwargs=kwargs)
-        thr.start()
-    return wrapper
-
-
 class APIResponse():
 
     def __init__(self, status_code=None, message=None, payload=None, **kwargs):
@@ -176,6 +184,31 @@ class RequestParser(reqparse.RequestParser):
 reqparse.RequestParser = RequestParser
 
 
+response_cache = cache.create('response',
+    ttl=app.config['RESPONSE_CACHE_TTL'],
+    max_size=app.config['RESPONSE_CACHE_SIZE'],
+)
+
+
+def cached_response(key, build):
+    """ Serve the json bytes of the response from build cached under key,
+    which should include a data version, with an ETag.
+
+    Clients revalidate with If-None-Match and get a 304 when the data has
+    not changed.
+    """
+    item = response_cache.get(key)
+    if item is None:
+        data = build().get_data()
+        item = (hashlib.md5(data).hexdigest(), data)
+        response_cache.set(key, item)
+    etag, data = item
+    response = app.response_class(data, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
 def json_type(data, name='json'):
     try:
         return json.loads(data)
@@ -206,6 +239,9 @@ def check_password_confirm(password, password_confirm):
         raise APIException(API_CODE_PASSWORD_CONFIRM_INVALID)
 
 
+CURSOR_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
 def strfdate(d):
     """ Convert from datetime.date object to string. """
     return d.strftime(app.config['DATE_FORMAT'])
@@ -236,16 +272,200 @@ def strpdatetime(dt):
     return datetime.strptime(dt, app.config['DATETIME_FORMAT'])
 
 
-def get_stringio_and_md5_from_stream(stream):
+def encode_cursor(key, id):
+    """ Encode the sort key and id of the last item of a page to an opaque
+    cursor. A key of None is encoded as an empty string. """
+    if key is None:
+        key = ''
+    elif hasattr(key, 'strftime'):
+        key = key.strftime(CURSOR_DATETIME_FORMAT)
+    return base64.urlsafe_b64encode('{}|{}'.format(key, id))
+
+
+def decode_cursor(cursor, key_type=datetime, name='cursor',
+    nullable=False):
+    """ Decode a cursor from encode_cursor back to (key, id). An empty key
+    is None, which is only valid when nullable. """
+    try:
+        key, id = base64.urlsafe_b64decode(str(cursor)).rsplit('|', 1)
+        if not key:
+            if not nullable:
+                raise ValueError(cursor)
+            key = None
+        elif key_type is datetime:
+            key = datetime.strptime(key, CURSOR_DATETIME_FORMAT)
+        else:
+            key = key_type(key)
+        return key, int(id)
+    except:
+        raise APIException(API_CODE_INVALID, name=name)
+
+
+def tree_type(value):
+    """ Parse "a,b.c,b.d" into {'a': {}, 'b': {'c': {}, 'd': {}}}.
+
+    Used for the `fields` and `expand` query arguments.
+    """
+    res = {}
+    for path in value.split(','):
+        node = res
+        for key in path.strip().split('.'):
+            if key:
+                node = node.setdefault(key, {})
+    return res
+
+
+def select_fields(values, fields=None, expand=None, relations=None):
+    """ Build a serialized dict honoring `fields` and `expand`.
+
+    values maps keys to plain values, or to callables which are only called
+    when the key is selected by `fields` (None selects all). relations maps
+    keys of embedded objects to a pair of their id and a callable taking the
+    nested `fields` and `expand`. A relation not listed in `expand` (None
+    expands all) is only represented by its id, which may be callable too.
+    """
+    res = {}
+    for key, value in values.items():
+        if fields and key not in fields:
+            continue
+        res[key] = value() if callable(value) else value
+    for key, (id, embed) in (relations or {}).items():
+        if fields and key not in fields:
+            continue
+        if expand is not None and key not in expand:
+            res[key] = id() if callable(id) else id
+        else:
+            res[key] = embed(**sub_fields(key, fields, expand))
+    return res
+
+
+def is_selected(key, fields=None):
+    return not fields or key in fields
+
+
+def is_expanded(key, fields=None, expand=None):
+    return is_selected(key, fields) and (expand is None or key in expand)
+
+
+def sub_fields(key, fields=None, expand=None):
+    """ The `fields` and `expand` to pass to the serializer of relation key.
+    """
+    return dict(
+        fields=(fields or {}).get(key) or None,
+        expand=None if expand is None else expand.get(key, {}),
+    )
+
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 12
+KM_PER_DEGREE = 111.32
+
+
+def location_type(value):
+    """ Parse "lng,lat" into a (longitude, latitude) tuple of floats. """
+    longitude, latitude = [float(x) for x in value.split(',')]
+    if not -180 <= longitude <= 180 or not -90 <= latitude <= 90:
+        raise ValueError('location out of range')
+    return longitude, latitude
+
+
+def geohash_encode(longitude, latitude, precision=GEOHASH_PRECISION):
+    lng_range = [-180.0, 180.0]
+    lat_range = [-90.0, 90.0]
+    res = []
+    bits = 0
+    num_bits = 0
+    while len(res) < precision:
+        if num_bits % 2 == 0:
+            value_range, value = lng_range, longitude
+        else:
+            value_range, value = lat_range, latitude
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            value_range[0] = mid
+        else:
+            bits = bits * 2
+            value_range[1] = mid
+        num_bits += 1
+        if num_bits % 5 == 0:
+            res.append(GEOHASH_BASE32[bits])
+            bits = 0
+    return ''.join(res)
+
+
+def geohash_cell_size(precision):
+    """ Width and height in degrees of a geohash cell. """
+    return (360.0 / 2 ** ((5 * precision + 1) // 2),
+        180.0 / 2 ** (5 * precision // 2))
+
+
+def geohash_cells(longitude, latitude, radius):
+    """ Geohashes of the cell containing the point and its 8 neighbours.
+
+    The precision is the finest one whose cells are no smaller than radius
+    km, so together they cover the circle around the point.
+    """
+    cos_latitude = max(math.cos(math.radians(latitude)), 0.01)
+    precision = 1
+    while precision < GEOHASH_PRECISION:
+        width, height = geohash_cell_size(precision + 1)
+        if width * KM_PER_DEGREE * cos_latitude < radius or \
+            height * KM_PER_DEGREE < radius:
+            break
+        precision += 1
+    width, height = geohash_cell_size(precision)
+    return sorted(set(geohash_encode(
+        (longitude + dx * width + 180) % 360 - 180,
+        min(max(latitude + dy * height, -90.0), 90.0),
+        precision,
+    ) for dx in (-1, 0, 1) for dy in (-1, 0, 1)))
+
+
+def distance_km(distance):
+    """ Convert a squared distance in degrees, see Community.nearby_filter,
+    to km. """
+    return round(math.sqrt(distance) * KM_PER_DEGREE, 3)
+
+
+def group_by(items, infos, key):
+    """ Group infos into lists keyed by the attribute `key` of items. """
+    res = {}
+    for item, info in zip(items, infos):
+        res.setdefault(getattr(item, key), []).append(info)
+    return res
+
+
+def spool_and_md5_from_stream(stream, folder):
+    """ Copy stream into a temporary file in folder while hashing it.
+
+    Only one block of `BLOCKSIZE` is held in memory at a time. Return the
+    path of the temporary file and the md5 of the content.
+    """
+    makedirs(folder)
     hasher = hashlib.md5()
-    stringio = StringIO.StringIO()
-    buf = stream.read(app.config['BLOCKSIZE'])
-    while len(buf) > 0:
-        hasher.update(buf)
-        stringio.write(buf)
-        buf = stream.read(app.config['BLOCKSIZE'])
-    stringio.seek(0)
-    return stringio, hasher.hexdigest()
+    fd, tmp_path = tempfile.mkstemp(prefix='.upload-', dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            buf = stream.read(app.config['BLOCKSIZE'])
+            while len(buf) > 0:
+                hasher.update(buf)
+                fout.write(buf)
+                buf = stream.read(app.config['BLOCKSIZE'])
+        os.chmod(tmp_path, 0644)
+    except:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, hasher.hexdigest()
+
+
+def makedirs(dir_path):
+    """ Create dir_path if it does not exist, safe against races. """
+    try:
+        os.makedirs(dir_path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
 
 
 def get_path_from_md5(folder, file_md5):
@@ -261,16 +481,33 @@ def get_url_from_md5(folder, file_md5):
         return None
 
 
+MD5_PATTERN = re.compile("^[0-9a-f]{32}$")
+
+
+def get_md5_from_url(url):
+    """ Recover the md5 from a path built by get_url_from_md5. """
+    parts = url.rstrip('/').split('/')
+    file_md5 = ''.join(parts[-3:])
+    if len(parts) >= 3 and [len(part) for part in parts[-3:]] == [2, 2, 28] \
+        and MD5_PATTERN.match(file_md5):
+        return file_md5
+    return None
+
+
 def save_file(stream, folder):
     if stream:
-        file_stringio, file_md5 = get_stringio_and_md5_from_stream(stream)
+        tmp_path, file_md5 = spool_and_md5_from_stream(stream, folder)
         file_path = get_path_from_md5(folder, file_md5)
-        dir_path = os.path.dirname(file_path)
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
-        if not os.path.isfile(file_path):
-            with open(file_path, 'wb') as fout:
-                copyfileobj(file_stringio, fout, app.config['BLOCKSIZE'])
+        try:
+            if os.path.isfile(file_path):
+                os.remove(tmp_path)
+            else:
+                makedirs(os.path.dirname(file_path))
+                os.rename(tmp_path, file_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
         return file_md5
     else:
         return ""
@@ -285,7 +522,6 @@ def verify_mobile(mobile):
     return False
 
 
-@async
 def send_async_sms(mobile, message):
     payload = {
         'cdkey': app.config['EMY_CDKEY'],
@@ -293,8 +529,9 @@ def send_async_sms(mobile, message):
         'phone': mobile,
         'message': message,
     }
-    r = requests.post(app.config['EMY_URL'], data=payload)
-    return r
+    if not sms.dispatcher.send(app.config['EMY_URL'], payload):
+        raise APIException(API_CODE_CAPTCHA_SMS_BUSY)
+    return True
 
 
 def send_captcha_sms(mobile, captcha):
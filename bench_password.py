@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: bench_password.py
+Author: huxuan
+Email: i(at)huxuan.org
+Description: Script to measure the logins per second per core of password
+hashing policies.
+
+Usage: python bench_password.py [method ...], the configured method and a few
+common ones by default. Each login is one password check in this single
+process, so the rate is what one core sustains on /oauth/token.
+"""
+from timeit import default_timer
+import sys
+
+from app import app
+from app import hashing
+
+METHODS = [
+    'pbkdf2:sha1:1000',
+    'pbkdf2:sha256:10000',
+    'pbkdf2:sha256:50000',
+    'pbkdf2:sha256:150000',
+]
+PASSWORD = 'fangmi-benchmark'
+MIN_SECONDS = 1
+MIN_ROUNDS = 10
+
+
+def benchmark(method):
+    pwhash = hashing.generate(PASSWORD, method=method)
+    rounds = 0
+    start = default_timer()
+    while rounds < MIN_ROUNDS or default_timer() - start < MIN_SECONDS:
+        hashing.check(pwhash, PASSWORD)
+        rounds += 1
+    return (default_timer() - start) / rounds
+
+
+methods = sys.argv[1:] or METHODS
+if not sys.argv[1:] and app.config['PASSWORD_HASH_METHOD'] not in methods:
+    methods.append(app.config['PASSWORD_HASH_METHOD'])
+print '{:<28}{:>12}{:>20}'.format('method', 'ms/login', 'logins/sec/core')
+for method in methods:
+    seconds = benchmark(method)
+    print '{:<28}{:>12.2f}{:>20.1f}{}'.format(method, seconds * 1000,
+        1 / seconds,
+        ' *' if method == app.config['PASSWORD_HASH_METHOD'] else '')
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: cache_server.py
+Author: huxuan
+Email: i(at)huxuan.org
+Description: A stand-in Redis server for the redis cache and notifier
+backends.
+
+It keeps everything in memory and only understands the commands these
+backends send: PING, GET, SET (with EX), DEL, KEYS, FLUSHDB, SELECT, CLIENT,
+SUBSCRIBE, UNSUBSCRIBE and PUBLISH. Usage: python cache_server.py [port]
+"""
+from fnmatch import fnmatchcase
+from threading import Lock
+from time import time
+import SocketServer
+import sys
+
+data = {}
+subscribers = {}
+lock = Lock()
+
+
+class Status(str):
+    """ A simple string reply. """
+
+
+class RedisHandler(SocketServer.StreamRequestHandler):
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.write_lock = Lock()
+        self.channels = set()
+
+    def finish(self):
+        with lock:
+            for channel in self.channels:
+                subscribers.get(channel, set()).discard(self)
+        SocketServer.StreamRequestHandler.finish(self)
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith('*'):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def send(self, value):
+        with self.write_lock:
+            self.write(value)
+            self.wfile.flush()
+
+    def write(self, value):
+        if value is None:
+            self.wfile.write('$-1\r\n')
+        elif isinstance(value, bool):
+            self.wfile.write('+OK\r\n')
+        elif isinstance(value, Status):
+            self.wfile.write('+{}\r\n'.format(value))
+        elif isinstance(value, int):
+            self.wfile.write(':{}\r\n'.format(value))
+        elif isinstance(value, list):
+            self.wfile.write('*{}\r\n'.format(len(value)))
+            for item in value:
+                self.write(item)
+        else:
+            self.wfile.write('${}\r\n{}\r\n'.format(len(value), value))
+
+    def handle(self):
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            if not args:
+                continue
+            command = args[0].upper()
+            handler = getattr(self, 'do_' + command.lower(), None)
+            if handler is None:
+                with self.write_lock:
+                    self.wfile.write('-ERR unknown command {}\r\n'.format(
+                        command))
+                    self.wfile.flush()
+                continue
+            with lock:
+                res = handler(*args[1:])
+            if res is not None or command == 'GET':
+                self.send(res)
+
+    def get_item(self, key):
+        item = data.get(key)
+        if item is not None and item[0] is not None and item[0] < time():
+            del data[key]
+            return None
+        return item
+
+    def do_ping(self, *args):
+        if self.channels:
+            return ['pong', '']
+        return Status('PONG')
+
+    def do_select(self, *args):
+        return True
+
+    def do_client(self, *args):
+        return True
+
+    def do_get(self, key):
+        item = self.get_item(key)
+        return item and item[1]
+
+    def do_set(self, key, value, *options):
+        expires = None
+        options = [option.upper() for option in options]
+        if 'EX' in options:
+            expires = time() + int(options[options.index('EX') + 1])
+        data[key] = (expires, value)
+        return True
+
+    def do_del(self, *keys):
+        return len([data.pop(key) for key in keys
+            if self.get_item(key) is not None])
+
+    def do_keys(self, pattern):
+        return [key for key in data.keys()
+            if self.get_item(key) is not None and fnmatchcase(key, pattern)]
+
+    def do_flushdb(self, *args):
+        data.clear()
+        return True
+
+    def do_subscribe(self, *channels):
+        for channel in channels:
+            self.channels.add(channel)
+            subscribers.setdefault(channel, set()).add(self)
+            self.send(['subscribe', channel, len(self.channels)])
+
+    def do_unsubscribe(self, *channels):
+        for channel in channels or list(self.channels):
+            self.channels.discard(channel)
+            subscribers.get(channel, set()).discard(self)
+            self.send(['unsubscribe', channel, len(self.channels)])
+
+    def do_publish(self, channel, message):
+        receivers = list(subscribers.get(channel, ()))
+        for receiver in receivers:
+            receiver.send(['message', channel, message])
+        return len(receivers)
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 6379
+    SocketServer.ThreadingTCPServer.allow_reuse_address = True
+    server = SocketServer.ThreadingTCPServer(('127.0.0.1', port),
+        RedisHandler)
+    server.serve_forever()
@@ -26,6 +26,57 @@ SQLALCHEMY_DATABASE_URI = 'mysql://{}:{}@{}/{}'.format(
     DB_USERNAME, DB_PASSWORD, DB_SERVER, DB_NAME)
 # SQLALCHEMY_COMMIT_ON_TEARDOWN = True
 
+# Per request query count and SQL time, reported by response headers in debug
+# mode and by a json log line otherwise.
+QUERY_STATS = True
+# The maximum number of duplicate statements included in the log line.
+QUERY_STATS_MAX_DUPLICATES = 5
+
+# Cache backend for hot reads: `local` (in-process LRU, one per worker),
+# `uwsgi` (shared memory of the uWSGI workers on one host, see the cache2
+# option in fangmi-api.ini) or `redis` (network, python cache_server.py
+# runs a local stand-in, see `make cache`). The *_CACHE_SIZE options only
+# bound `local`. Only `redis` is coherent across the workers of both
+# fangmi-api.ini and fangmi-api-stream.ini, with `local` a revoked token keeps
+# working in the other workers for up to TOKEN_CACHE_TTL.
+CACHE_BACKEND = 'redis'
+CACHE_KEY_PREFIX = 'fangmi:'
+CACHE_UWSGI_NAME = 'fangmi'
+CACHE_REDIS_URL = 'redis://localhost:6379/0'
+CACHE_REDIS_TIMEOUT_SECONDS = 1
+
+# Cache of OAuth access tokens with their users.
+TOKEN_CACHE_SIZE = 1024
+TOKEN_CACHE_TTL = 60
+
+# Cache of reference data responses, keyed by data version.
+RESPONSE_CACHE_SIZE = 64
+RESPONSE_CACHE_TTL = 3600
+
+# Default and maximum number of messages per page of /api/message/list.
+MESSAGE_PAGE_SIZE = 20
+MESSAGE_MAX_PAGE_SIZE = 100
+
+# /api/message/stream closes after MESSAGE_STREAM_TIMEOUT_SECONDS, clients
+# reconnect with Last-Event-ID. In production the streams are served by the
+# gevent workers of fangmi-api-stream.ini, so an open stream only holds a
+# greenlet, and a database connection just for the duration of each query.
+MESSAGE_STREAM_TIMEOUT_SECONDS = 60
+MESSAGE_STREAM_HEARTBEAT_SECONDS = 15
+# How streams learn about new messages: `local` (this process only, enough
+# for run.py) or `redis` (all workers, python cache_server.py runs a local
+# stand-in). The streams of fangmi-api-stream.ini run in other processes than
+# the API which stores the messages, so they need `redis`.
+NOTIFIER_BACKEND = 'redis'
+NOTIFIER_REDIS_URL = 'redis://localhost:6379/0'
+
+# Password hashing policy in werkzeug's method format, e.g.
+# pbkdf2:sha256:10000 for 10000 iterations. Hashes made with another method
+# are rehashed on login, run bench_password.py to compare the logins per
+# second of the choices.
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:10000'
+PASSWORD_SALT_LENGTH = 16
+
 # The md5 for default avatar.
 DEFAULT_AVATAR_MD5 = '587c36119c43e7383b739e6093c23150'
 
@@ -34,14 +85,18 @@ DATE_FORMAT = '%Y-%m-%d'
 TIME_FORMAT = '%H:%M:%S'
 DATETIME_FORMAT = ' '.join([DATE_FORMAT, TIME_FORMAT])
 
-# Whoosh / Text Search related.
-WHOOSH_DIR = 'whoosh_index'
-WHOOSH_BASE = os.path.realpath(os.path.join(
-    os.path.dirname(__file__),
-    WHOOSH_DIR,
-))
-from jieba.analyse import ChineseAnalyzer
-WHOOSH_ANALYZER = ChineseAnalyzer()
+# Full text search backend, `mysql` (InnoDB FULLTEXT) or `sqlite` (FTS5).
+SEARCH_BACKEND = 'mysql'
+# Committed changes are indexed in batches of SEARCH_INDEX_BATCH_SIZE by a
+# background thread, at most SEARCH_INDEX_MAX_DELAY_SECONDS later.
+SEARCH_INDEX_MAX_DELAY_SECONDS = 5
+SEARCH_INDEX_BATCH_SIZE = 100
+# Rows read per query by db_search.py.
+SEARCH_REINDEX_BATCH_SIZE = 1000
+
+# Radius in km of /api/community/nearby and /api/apartment/list?near=.
+NEARBY_DEFAULT_RADIUS_KM = 3
+NEARBY_MAX_RADIUS_KM = 20
 
 # EMY Messaeg
 EMY_URL = 'http://sdk4report.eucp.b2m.cn:8080/sdkproxy/sendsms.action'
@@ -49,6 +104,15 @@ EMY_CDKEY = ''
 EMY_PASSWORD = ''
 EMY_MESSAGE = u'【房蜜科技】您的验证码为{}，感谢您使用房蜜。'
 EMY_TIMEDELTA_SECONDS = 60
+# Use the stub gateway in development, see /api/test/sms.
+# EMY_URL = 'http://localhost:5000/api/test/sms'
+
+# SMS dispatch worker pool.
+SMS_NUM_WORKERS = 2
+SMS_MAX_QUEUE_SIZE = 100
+SMS_MAX_RETRIES = 3
+SMS_RETRY_BACKOFF_SECONDS = 1
+SMS_TIMEOUT_SECONDS = 10
 
 # The maximum content size when uploading.
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024
@@ -115,3 +179,12 @@ UPLOAD_MESSAGE_FOLDER = os.path.realpath(os.path.join(
     UPLOAD_FOLDER,
     UPLOAD_MESSAGE_DIR,
 ))
+
+# Cache lifetime in seconds for uploaded files, which never change since they
+# are stored by md5.
+UPLOAD_MAX_AGE = 31536000
+
+# Hand file serving over to nginx with X-Accel-Redirect, keep it False when
+# running with run.py. The url must match the internal location in nginx.
+UPLOAD_ACCEL_REDIRECT = False
+UPLOAD_ACCEL_REDIRECT_URL = '/_uploads'
@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: db_availability.py
+Author: huxuan
+Email: i(at)huxuan.org
+Description: Script to roll over room availability, run once a day.
+"""
+from app import db
+from app import models
+
+models.Room.update_availability()
+db.session.commit()
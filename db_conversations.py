@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: db_conversations.py
+Author: huxuan
+Email: i(at)huxuan.org
+Description: Script to rebuild conversation summaries from messages.
+"""
+from app import models
+
+models.Conversation.rebuild()
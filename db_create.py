@@ -7,5 +7,7 @@ Email: i(at)huxuan.org
 Description: Script to create database.
 """
 from app import db
+from app import search
 
 db.create_all()
+search.create_all()
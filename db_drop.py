@@ -12,4 +12,6 @@ confirm = raw_input()
 
 if confirm == 'fangmi':
     from app import db
+    from app import search
+    search.drop_all()
     db.drop_all()
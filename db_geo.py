@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: db_geo.py
+Author: huxuan
+Email: i(at)huxuan.org
+Description: Script to parse the location of existing communities.
+"""
+from app import db
+from app import models
+
+for community in models.Community.query.all():
+    community.location = community.location
+db.session.commit()
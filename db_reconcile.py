@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: db_reconcile.py
+Author: huxuan
+Email: i(at)huxuan.org
+Description: Script to recompute denormalized columns in bulk.
+"""
+from app import db
+from app import models
+
+models.Apartment.update_prices()
+models.Apartment.update_counters()
+models.User.update_counters()
+db.session.commit()
@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+File: db_search.py
+Author: huxuan
+Email: i(at)huxuan.org
+Description: Script to rebuild the full text search tables.
+"""
+from app import search
+
+search.create_all()
+for model in search.searchables.values():
+    search.reindex(model)